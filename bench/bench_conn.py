@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the wire layer in keepassc.conn
+
+A message is sent from one thread and received by another over a
+socketpair, loopback TCP or loopback TLS. For every transport, framing mode
+and payload size the throughput, the socket calls per message and the peak
+memory of a transfer are measured. The results are written as JSON so that
+runs of different releases can be compared, e.g.
+
+    python bench/bench_conn.py -o before.json
+    python bench/bench_conn.py -p /path/to/other/checkout -o after.json
+
+Framing modes:
+    build_message   only build_message(), no transport
+    legacy          build_message(), sendmsg() and receive()
+    framed          Connection.send() and Connection.receive()
+    zlib, lzma      framed with compression
+
+TLS needs servercert.pem and serverkey.pem, like keepassc-server; pass
+their directory with -t.
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import socket
+import ssl
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from os.path import abspath, dirname, join
+
+SIZES = (100, 1000, 10000, 100000, 1000000, 10000000, 50000000)
+TRANSPORTS = ('socketpair', 'tcp', 'tls')
+MODES = ('build_message', 'legacy', 'framed', 'zlib', 'lzma')
+
+# Messages per repetition are chosen so that about this many bytes are
+# transferred, small payloads are sent many times
+BYTES_PER_REPEAT = 1 << 22
+MAX_MESSAGES = 1000
+
+# Socket calls which are counted. SSLSocket.sendall calls send for every
+# chunk, so it isn't counted for TLS.
+PLAIN_CALLS = ('send', 'sendall', 'sendmsg', 'recv', 'recv_into')
+TLS_CALLS = ('send', 'recv', 'recv_into')
+
+def arg_parse():
+    "Parse the command line arguments"
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', default=None,
+                        help='Comma separated payload sizes in bytes.',
+                        type=str)
+    parser.add_argument('-T', '--transports', default=','.join(TRANSPORTS),
+                        help='Comma separated transports.', type=str)
+    parser.add_argument('-m', '--modes', default=','.join(MODES),
+                        help='Comma separated framing modes.', type=str)
+    parser.add_argument('-r', '--repeat', default=5,
+                        help='Repetitions of every measurement.', type=int)
+    parser.add_argument('-d', '--data', default='random',
+                        choices=['random', 'text'],
+                        help='Incompressible or compressible payloads.')
+    parser.add_argument('-t', '--tls_dir', default=None,
+                        help='Directory with servercert.pem and '
+                             'serverkey.pem.', type=str)
+    parser.add_argument('-p', '--path', default=None,
+                        help='Import keepassc from this directory instead '
+                             'of this checkout.', type=str)
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write JSON to this file instead of stdout.',
+                        type=str)
+    return parser.parse_args()
+
+def counting(cls, names):
+    """Subclass a socket class to count calls of the methods in names
+
+    All instances share one Counter, calls.
+
+    """
+
+    counted = type('Counting' + cls.__name__, (cls,),
+                   {'calls': collections.Counter()})
+    for name in names:
+        def method(self, *args, _name = name, _orig = getattr(cls, name),
+                   **kwargs):
+            self.calls[_name] += 1
+            return _orig(self, *args, **kwargs)
+        setattr(counted, name, method)
+    return counted
+
+CountingSocket = counting(socket.socket, PLAIN_CALLS)
+CountingSSLSocket = counting(ssl.SSLSocket, TLS_CALLS)
+
+def make_payload(size, data):
+    """Get a payload which doesn't contain the legacy terminator"""
+
+    if data == 'text':
+        text = b'Title: example\nURL: https://example.org\nUsername: user\n'
+        payload = text * (size // len(text) + 1)
+    else:
+        # No byte \xDE, so there is no b'\xDE\xAD\xE1\x1D' either
+        payload = os.urandom(size).replace(b'\xDE', b'\xDF')
+    return payload[:size]
+
+def plain_pair(transport):
+    """Connect two counting sockets over a socketpair or loopback TCP"""
+
+    if transport == 'socketpair':
+        first, second = socket.socketpair()
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        first = socket.create_connection(listener.getsockname())
+        second = listener.accept()[0]
+        listener.close()
+    return tuple(CountingSocket(i.family, i.type, i.proto, i.detach())
+                 for i in (first, second))
+
+def tls_pair(tls_dir):
+    """Connect two counting TLS sockets over loopback TCP"""
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(join(tls_dir, 'servercert.pem'),
+                                   join(tls_dir, 'serverkey.pem'))
+    server_context.sslsocket_class = CountingSSLSocket
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    client_context.sslsocket_class = CountingSSLSocket
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    accepted = []
+    def accept():
+        sock = listener.accept()[0]
+        accepted.append(server_context.wrap_socket(sock, server_side = True))
+    accept_thread = threading.Thread(target=accept)
+    accept_thread.start()
+    first = client_context.wrap_socket(
+        socket.create_connection(listener.getsockname()))
+    accept_thread.join()
+    listener.close()
+    return (first, accepted[0])
+
+def make_endpoints(kpconn, mode, sender, receiver):
+    """Get a send and a receive function for a framing mode"""
+
+    if mode == 'legacy':
+        return (lambda payload: kpconn.sendmsg(
+                    sender, kpconn.build_message((b'FIND', payload))),
+                lambda: kpconn.receive(receiver))
+
+    sending = kpconn.Connection(sender, True)
+    receiving = kpconn.Connection(receiver, True)
+    if mode != 'framed':
+        compression = {'zlib': kpconn.ZLIB, 'lzma': kpconn.LZMA}[mode]
+        for i in (sending, receiving):
+            i.compression = compression
+    return (lambda payload: sending.send(b'FIND', payload),
+            receiving.receive)
+
+def transfer(send, receive, payload, messages):
+    """Send messages from a thread and receive them
+
+    The legacy receive() drops whatever follows the end of a message, so
+    the next message is only sent after the last one was received. This
+    is done in every mode so that they stay comparable. Returns the
+    seconds it took.
+
+    """
+
+    errors = []
+    received = threading.Semaphore(0)
+    def send_all():
+        try:
+            for i in range(messages):
+                send(payload)
+                received.acquire()
+        except Exception as err:
+            errors.append(err)
+    sender = threading.Thread(target=send_all)
+    start = time.perf_counter()
+    sender.start()
+    for i in range(messages):
+        msg = receive()
+        received.release()
+    seconds = time.perf_counter() - start
+    sender.join()
+    if errors:
+        raise errors[0]
+    # The command and the break are part of the message
+    if len(msg) != len(payload) + 7:
+        raise ValueError('Received ' + str(len(msg)) + ' bytes instead of ' +
+                         str(len(payload) + 7))
+    return seconds
+
+def bench_build_message(kpconn, payload, messages, repeat):
+    """Measure build_message() without a transport"""
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(messages):
+            kpconn.build_message((b'FIND', payload))
+        times.append((time.perf_counter() - start) / messages)
+    tracemalloc.start()
+    kpconn.build_message((b'FIND', payload))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (times, {}, peak)
+
+def bench_transport(kpconn, transport, mode, payload, messages, repeat,
+                    tls_dir):
+    """Measure a framing mode over a transport"""
+
+    if transport == 'tls':
+        sender, receiver = tls_pair(tls_dir)
+        counter = CountingSSLSocket.calls
+    else:
+        sender, receiver = plain_pair(transport)
+        counter = CountingSocket.calls
+    try:
+        send, receive = make_endpoints(kpconn, mode, sender, receiver)
+        # Warm up, e.g. the receive buffer of a Connection
+        transfer(send, receive, payload, 1)
+
+        times = []
+        for i in range(repeat):
+            times.append(transfer(send, receive, payload, messages) /
+                         messages)
+
+        counter.clear()
+        transfer(send, receive, payload, 1)
+        calls = dict(counter)
+
+        tracemalloc.start()
+        transfer(send, receive, payload, 1)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        sender.close()
+        receiver.close()
+    return (times, calls, peak)
+
+def run(args, kpconn):
+    """Run all benchmarks and return the results"""
+
+    if args.sizes is not None:
+        sizes = [int(i) for i in args.sizes.split(',')]
+    else:
+        sizes = SIZES
+    modes = args.modes.split(',')
+    transports = args.transports.split(',')
+    if 'tls' in transports and args.tls_dir is None:
+        print('Skipping TLS, no certificate directory given', file=sys.stderr)
+        transports.remove('tls')
+
+    results = []
+    for size in sizes:
+        payload = make_payload(size, args.data)
+        messages = max(1, min(MAX_MESSAGES, BYTES_PER_REPEAT // size))
+        for mode in modes:
+            if mode == 'build_message':
+                cases = [None]
+            else:
+                cases = transports
+            for transport in cases:
+                result = {'transport': transport, 'mode': mode,
+                          'size': size, 'messages': messages,
+                          'repeat': args.repeat}
+                try:
+                    if transport is None:
+                        times, calls, peak = bench_build_message(
+                            kpconn, payload, messages, args.repeat)
+                    else:
+                        times, calls, peak = bench_transport(
+                            kpconn, transport, mode, payload, messages,
+                            args.repeat, args.tls_dir)
+                except Exception as err:
+                    # E.g. a mode an older release doesn't support
+                    result['error'] = err.__class__.__name__ + ': ' + \
+                                      err.__str__()
+                else:
+                    median = statistics.median(times)
+                    result['seconds_median'] = median
+                    result['seconds_min'] = min(times)
+                    result['bytes_per_second'] = size / median
+                    result['socket_calls'] = calls
+                    result['peak_memory'] = peak
+                print(format_result(result), file=sys.stderr)
+                results.append(result)
+    return results
+
+def format_result(result):
+    """Format a result as a line for the terminal"""
+
+    name = '{:>10} {:>13} {:>9}'.format(result['transport'] or '-',
+                                          result['mode'], result['size'])
+    if 'error' in result:
+        return name + '  ' + result['error']
+    return (name + ' {:>10.1f} MB/s {:>8.1f} us {:>5} calls {:>12} B peak'
+            .format(result['bytes_per_second'] / 1e6,
+                    result['seconds_median'] * 1e6,
+                    sum(result['socket_calls'].values()),
+                    result['peak_memory']))
+
+if __name__ == '__main__':
+    args = arg_parse()
+    if args.path is not None:
+        sys.path.insert(0, abspath(args.path))
+    else:
+        sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    import keepassc.conn as kpconn
+
+    report = {'module': kpconn.__file__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'openssl': ssl.OPENSSL_VERSION,
+              'data': args.data,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'results': run(args, kpconn)}
+    if args.output is not None:
+        with open(args.output, 'w') as handler:
+            json.dump(report, handler, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,127 @@
+"""This module limits how often peers may authenticate.
+
+Checking a password transforms the key with all rounds of the database,
+so every attempt costs a lot of CPU time, no matter if the password is
+right or wrong.
+
+Classes:
+    TokenBucket(object)
+    Admission(object)
+"""
+
+import threading
+import time
+
+class TokenBucket(object):
+    """A token bucket which holds up to burst tokens
+
+    rate tokens are added per second. Every attempt takes one token.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        """Add the tokens which accrued since the last refill"""
+
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now):
+        """Take a token, returns False if there is none"""
+
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now):
+        """Check if the bucket is back at burst tokens"""
+
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class Admission(object):
+    """Admit authentication attempts per peer
+
+    A peer may run at most concurrency attempts at the same time and may
+    start rate attempts per second with bursts of up to burst attempts.
+    A value of 0 turns the respective limit off. Attempts which aren't
+    admitted are rejected before any key is transformed.
+
+    Peers are identified by their address, Unix domain socket clients all
+    share the peer 'unix'.
+
+    """
+
+    # Buckets of peers which didn't try for a while are dropped when there
+    # are more of them
+    MAX_IDLE_BUCKETS = 1024
+
+    def __init__(self, concurrency, rate, burst):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        # Attempts which are running per peer
+        self.running = {}
+        self.stats = {'admitted': 0, 'rate_limited': 0,
+                      'concurrency_limited': 0}
+
+    def admit(self, peer):
+        """Admit an attempt of peer
+
+        Returns None if the attempt may go on, release() has to be called
+        after it then. Otherwise the reason of the rejection is returned.
+
+        """
+
+        with self.lock:
+            running = self.running.get(peer, 0)
+            if self.concurrency > 0 and running >= self.concurrency:
+                self.stats['concurrency_limited'] += 1
+                return 'Too many authentications at the same time'
+            if self.rate > 0:
+                now = time.monotonic()
+                bucket = self.buckets.get(peer)
+                if bucket is None:
+                    if len(self.buckets) >= self.MAX_IDLE_BUCKETS:
+                        self.prune(now)
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self.buckets[peer] = bucket
+                if bucket.take(now) is False:
+                    self.stats['rate_limited'] += 1
+                    return 'Too many authentications, try again later'
+            self.running[peer] = running + 1
+            self.stats['admitted'] += 1
+            return None
+
+    def release(self, peer):
+        """Finish an admitted attempt of peer"""
+
+        with self.lock:
+            running = self.running[peer] - 1
+            if running == 0:
+                del self.running[peer]
+            else:
+                self.running[peer] = running
+
+    def prune(self, now):
+        """Drop the buckets which are full again, lock is held"""
+
+        for peer in [peer for peer, bucket in self.buckets.items()
+                     if bucket.is_full(now)]:
+            del self.buckets[peer]
+
+    def get_stats(self):
+        """Get a copy of the counters"""
+
+        with self.lock:
+            return dict(self.stats)
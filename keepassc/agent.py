@@ -1,17 +1,16 @@
 """This module implements an agent for KeePassC
 
     Classes:
-        Agent(Client, Daemon)
+        Agent(Daemon)
 """
 
 import logging
 import signal
 import socket
-import ssl
 import sys
-from hashlib import sha256
-from os import chdir
-from os.path import expanduser, realpath, isfile, join
+import time
+from os import chdir, getuid, remove
+from os.path import expanduser, realpath, join
 
 from keepassc.conn import *
 from keepassc.client import Client
@@ -24,8 +23,11 @@ class Agent(Daemon):
     def __init__(self, pidfile, loglevel, logfile,
                  server_address = 'localhost', server_port = 50000,
                  agent_port = 50001, password = None, keyfile = None,
-                 tls = False, tls_dir = None):
+                 tls = False, tls_dir = None, compression = None,
+                 compression_level = None, unix_socket = None,
+                 idle_exit = 0):
         Daemon.__init__(self, pidfile)
+        self.started = time.monotonic()
 
         try:
             logdir = realpath(expanduser(getenv('XDG_DATA_HOME')))
@@ -41,22 +43,46 @@ class Agent(Daemon):
 
         self.lookup = {
             b'FIND': self.find,
+            b'FINDF': self.find_fields,
             b'GET': self.get_db,
             b'GETC': self.get_credentials}
 
         self.server_address = (server_address, server_port)
+        # If a path is given the agent listens on a Unix domain socket
+        # instead of the port
+        self.unix_socket = unix_socket
+        # Without a request for idle_exit seconds the agent stops itself,
+        # 0 keeps it running
+        self.idle_exit = idle_exit
+        # A service manager like systemd may have bound the socket already
+        # and starts the agent on the first connection
+        inherited = inherited_sockets()
+        self.inherited = bool(inherited)
         try:
             # Listen for commands
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.bind(("localhost", agent_port))
-            self.sock.listen(1)
+            if inherited:
+                self.sock = inherited[0]
+                # The socket file belongs to the service manager
+                self.unix_socket = None
+            elif unix_socket is not None:
+                self.sock = listen_unix(unix_socket, 1)
+            else:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.bind(("localhost", agent_port))
+                self.sock.listen(1)
         except OSError as err:
             print(err)
             logging.error(err.__str__())
             sys.exit(1)
         else:
-            logging.info('Agent socket created on localhost:'+
-                         str(agent_port))
+            if inherited:
+                logging.info('Inherited socket on '+
+                             str(self.sock.getsockname()))
+            elif unix_socket is not None:
+                logging.info('Agent socket created on '+unix_socket)
+            else:
+                logging.info('Agent socket created on localhost:'+
+                             str(agent_port))
 
         if tls_dir is not None:
             self.tls_dir = realpath(expanduser(tls_dir)).encode()
@@ -74,104 +100,88 @@ class Agent(Daemon):
         else:
             self.keyfile = b''
 
-        if tls is True:
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            self.context.verify_mode = ssl.CERT_REQUIRED
-            self.context.load_verify_locations(tls_dir + "/cacert.pem")
-        else:
-            self.context = None
+        # The client keeps a session with the server between requests
+        self.client = Client(loglevel, logfile, server_address, server_port,
+                             password, None, tls, tls_dir, True,
+                             compression, compression_level)
+        self.client.key = self.keyfile
 
         #Handle SIGTERM
         signal.signal(signal.SIGTERM, self.handle_sigterm)
 
-    def send_cmd(self, *cmd):
-        """Overrides Client.connect_server"""
-
-        if self.password is None:
-            password = b''
-        else:
-            password = self.password.encode()
-
-        tmp = [password, self.keyfile]
-        tmp.extend(cmd)
-        cmd_chain = build_message(tmp)
-
-        try:
-            tmp_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if self.context is not None:
-                conn = self.context.wrap_socket(tmp_conn)
-            else:
-                conn = tmp_conn
-            conn.connect(self.server_address)
-        except:
-            raise
-        else:
-            logging.info('Connected to '+self.server_address[0]+':'+
-                         str(self.server_address[1]))
-
-        try:
-            conn.settimeout(60)
-            if self.context is not None:
-                if not isfile(self.tls_dir.decode() + '/pin'):
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    with open(self.tls_dir.decode() + '/pin', 'wb') as pin:
-                        pin.write(sha.digest())
-                else:
-                    with open(self.tls_dir.decode() + '/pin', 'rb') as pin:
-                        pinned_key = pin.read()
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    if pinned_key != sha.digest():
-                        return (b'FAIL: Server certificate differs from '
-                                b'pinned certificate')
-                cert = conn.getpeercert()
-                try:
-                    ssl.match_hostname(cert, "KeePassC Server")
-                except:
-                    return b'FAIL: TLS - Hostname does not match'
-            sendmsg(conn, cmd_chain)
-            answer = receive(conn)
-        except:
-            raise
-        finally:
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
-
-        return answer
-
     def run(self):
         """Overide Daemon.run() and provide sockets"""
 
+        if self.idle_exit > 0:
+            self.sock.settimeout(self.idle_exit)
+        logging.info('Ready after {0:.3f} seconds'
+                     .format(time.monotonic() - self.started))
         while True:
             try:
-                conn, client = self.sock.accept()
+                sock, client = self.sock.accept()
+            except socket.timeout:
+                logging.info('Idle for '+str(self.idle_exit)+
+                             ' seconds, stopping')
+                self.handle_sigterm(None, None)
+                break
             except OSError:
                 break
 
-            logging.info('Connected to '+client[0]+':'+str(client[1]))
-            conn.settimeout(60)
+            if self.sock.family == socket.AF_UNIX:
+                try:
+                    credentials = peer_credentials(sock)
+                except OSError as err:
+                    logging.error(err.__str__())
+                    sock.close()
+                    continue
+                # Without SO_PEERCRED the permissions of the socket file
+                # have to do
+                if credentials is not None and credentials[1] != getuid():
+                    logging.error('Refused connection from uid '+
+                                  str(credentials[1]))
+                    sock.close()
+                    continue
+            logging.info('Connected to '+peer_name(sock))
+            sock.settimeout(60)
+            conn = Connection(sock)
 
             try:
-                parts = receive(conn).split(b'\xB2\xEA\xC0')
-                cmd = parts.pop(0)
+                parts = conn.receive_first(FRAMED).split(b'\xB2\xEA\xC0')
+                cmd = bytes(parts.pop(0))
                 if cmd in self.lookup:
                     self.lookup[cmd](conn, parts)
                 else:
                     logging.error('Received a wrong command')
-                    sendmsg(conn, b'FAIL: Command isn\'t available')
+                    conn.send(b'FAIL: Command isn\'t available')
             except OSError as err:
                 logging.error(err.__str__())
             finally:
-                conn.shutdown(socket.SHUT_RDWR)
-                conn.close()
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
 
     def find(self, conn, cmd_misc):
-        """Find Entries"""
+        """Find Entries
+
+        Several titles are looked up with pipelined requests and the
+        answers are sent as parts of one message.
+
+        """
+
+        try:
+            answers = self.client.pipeline(*[(b'FIND', i) for i in cmd_misc])
+            conn.send(*answers)
+            for answer in answers:
+                if answer[:4] == b'FAIL':
+                    raise OSError(answer.decode())
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+
+    def find_fields(self, conn, cmd_misc):
+        """Find entries and get only some fields as records"""
 
         try:
-            answer = self.send_cmd(b'FIND', cmd_misc[0])
-            sendmsg(conn, answer)
+            answer = self.client.send_cmd(b'FINDF', *cmd_misc)
+            conn.send(answer)
             if answer[:4] == b'FAIL':
                 raise OSError(answer.decode())
         except (OSError, TypeError) as err:
@@ -181,8 +191,8 @@ class Agent(Daemon):
         """Get the whole encrypted database from server"""
 
         try:
-            answer = self.send_cmd(b'GET')
-            sendmsg(conn, answer)
+            answer = self.client.send_cmd(b'GET')
+            conn.send(answer)
             if answer[:4] == b'FAIL':
                 raise OSError(answer.decode())
         except (OSError, TypeError) as err:
@@ -195,7 +205,7 @@ class Agent(Daemon):
             password = b''
         else:
             password = self.password.encode()
-        if self.context:
+        if self.client.context:
             tls = b'True'
         else:
             tls = b'False'
@@ -203,16 +213,24 @@ class Agent(Daemon):
         tmp = [password, self.keyfile, self.server_address[0].encode(),
                str(self.server_address[1]).encode(), tls,
                self.tls_dir]
-        chain = build_message(tmp)
         try:
-            sendmsg(conn, chain)
+            conn.send(*tmp)
         except (OSError, TypeError) as err:
             logging.error(err.__str__())
 
     def handle_sigterm(self, signum, frame):
         """Handle SIGTERM"""
 
-        self.sock.shutdown(socket.SHUT_RDWR)
+        # The service manager keeps listening on an inherited socket
+        if self.inherited is False:
+            self.sock.shutdown(socket.SHUT_RDWR)
         self.sock.close()
+        if self.unix_socket is not None:
+            try:
+                remove(self.unix_socket)
+            except OSError:
+                pass
+        self.client.close()
         del self.keyfile
+        del self.client.key
 
@@ -4,6 +4,7 @@ Classes:
     Client(Connection)
 """
 
+import hmac
 import logging
 import socket
 import ssl
@@ -11,13 +12,55 @@ from os.path import join, expanduser, realpath, isfile
 from hashlib import sha256
 
 from keepassc.conn import *
+from keepassc.helper import get_final_key, get_key, stretch_key
+
+# Servers which didn't understand our hello are spoken to in legacy mode
+legacy_servers = set()
+
+# Pipelined commands which may wait for their answers at the same time
+PIPELINE_WINDOW = 16
+
+# Commands which don't change anything, so they may be sent again if a
+# session broke before their answer came
+IDEMPOTENT_COMMANDS = (b'FIND', b'FINDF', b'GET', b'LOGIN', b'CHALLENGE')
+
+# TLS contexts and pinned certificate digests by TLS directory, shared by
+# all clients of the process
+tls_contexts = {}
+tls_pins = {}
+# Last TLS session by TLS directory and server address; it's resumed by
+# the next connection to skip a full handshake
+tls_sessions = {}
+
+def get_tls_context(tls_dir):
+    """Get the TLS context for the CA certificate in tls_dir"""
+
+    context = tls_contexts.get(tls_dir)
+    if context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(tls_dir + "/cacert.pem")
+        tls_contexts[tls_dir] = context
+    return context
+
+def get_tls_pin(tls_dir):
+    """Get the pinned certificate digest or None if there is none yet"""
+
+    pin = tls_pins.get(tls_dir)
+    if pin is None and isfile(tls_dir + '/pin'):
+        with open(tls_dir + '/pin', 'rb') as handler:
+            pin = handler.read()
+        tls_pins[tls_dir] = pin
+    return pin
 
 class Client(object):
     """The KeePassC client"""
 
     def __init__(self, loglevel, logfile, server_address = 'localhost',
                  server_port = 50000, password = None, keyfile = None,
-                 tls = False, tls_dir = None):
+                 tls = False, tls_dir = None, session = False,
+                 compression = None, compression_level = None,
+                 tokens = True):
         try:
             logdir = realpath(expanduser(getenv('XDG_DATA_HOME')))
         except:
@@ -32,80 +75,343 @@ class Client(object):
 
         self.password = password
         self.keyfile = keyfile
-        self.server_address = (server_address, server_port)
+        # An absolute path is the Unix domain socket of a local server
+        if server_address.startswith('/'):
+            self.server_address = server_address
+        else:
+            self.server_address = (server_address, server_port)
 
         self.tls_dir = tls_dir
 
+        # Content of the keyfile, read on first use
+        self.key = None
+        # Session token which is sent instead of the credentials, so the
+        # server transforms the key only for LOGIN. It's False if tokens
+        # aren't used. Without a session LOGIN would cost connections of
+        # its own, such clients send their credentials instead.
+        if tokens is True and session is True:
+            self.token = None
+        else:
+            self.token = False
+        # The key transformed for a challenge of the server as a tuple of
+        # its seed, its rounds and the key
+        self.stretched = None
+
+        # If session is True the connection is kept open for the next
+        # command if the server supports it
+        self.session = session
+        self.conn = None
+
+        # compression is 'zlib' or 'lzma'; it's used if the server
+        # supports it
+        if compression is not None:
+            self.compression = compression.upper().encode()
+            if compression_level is not None:
+                self.compression += b'=' + str(compression_level).encode()
+        else:
+            self.compression = None
+        # Bytes sent and received by all connections of the client
+        self.traffic = new_traffic()
+
         if tls is True:
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            self.context.verify_mode = ssl.CERT_REQUIRED
-            logging.error(tls_dir)
-            self.context.load_verify_locations(tls_dir + "/cacert.pem")
+            self.context = get_tls_context(tls_dir)
         else:
             self.context = None
 
+    def get_credentials(self):
+        """Get password and keyfile content as bytestrings"""
+
+        if self.key is None:
+            if self.keyfile is not None:
+                with open(self.keyfile, 'rb') as keyfile:
+                    self.key = keyfile.read()
+            else:
+                self.key = b''
+        if self.password is None:
+            password = b''
+        else:
+            password = self.password.encode()
+        return (password, self.key)
+
+    def get_auth(self):
+        """Get the first two parts of a request
+
+        That's the session token or, if the server doesn't issue tokens,
+        the credentials. A token is fetched with LOGIN first. Returns the
+        FAIL message if LOGIN failed.
+
+        """
+
+        if self.token is None:
+            answer = self.login()
+            if answer is not None:
+                return answer
+        if self.token:
+            return (TOKEN, self.token)
+        return self.get_credentials()
+
+    def login(self):
+        """Get a session token for the credentials
+
+        Servers which don't know LOGIN get the credentials with every
+        request. Returns the FAIL message if LOGIN failed.
+
+        """
+
+        answer = self.get_connection()
+        if type(answer) is bytes:
+            return answer
+        # The next request takes this connection, whose hello shows if
+        # the server sends challenges
+        self.conn = answer[0]
+        if CHALLENGE in self.conn.capabilities:
+            answer = self.respond()
+        else:
+            answer = self.request(*self.get_credentials(), b'LOGIN')
+        if answer == b'FAIL: Command isn\'t available':
+            self.token = False
+        elif answer[:4] == b'FAIL':
+            return answer
+        else:
+            self.token = answer
+        return None
+
+    def respond(self):
+        """Log in with the response to a challenge of the server
+
+        The key is transformed here, so the credentials are never sent.
+        The transformed key is kept for the next challenge.
+
+        """
+
+        answer = self.request(RESPONSE, b'', b'CHALLENGE')
+        if answer[:4] == b'FAIL':
+            return answer
+        seed, rounds, final_seed, nonce = answer.split(BREAK)
+        seed = bytes.fromhex(seed.decode())
+        rounds = int(rounds)
+        if self.stretched is None or self.stretched[:2] != (seed, rounds):
+            key = stretch_key(get_key(self.password, self.get_credentials()[1]
+                                      or None, True), seed, rounds)
+            self.stretched = (seed, rounds, key)
+        final = get_final_key(self.stretched[2],
+                              bytes.fromhex(final_seed.decode()))
+        response = hmac.new(final, nonce, 'sha256').hexdigest().encode()
+        return self.request(RESPONSE, nonce+b':'+response, b'LOGIN')
+
+    def get_connection(self):
+        """Get the open session or connect to the server
+
+        Returns the connection and whether it's reused or a FAIL message.
+
+        """
+
+        conn = self.conn
+        self.conn = None
+        if conn is not None and conn.is_closed():
+            # The server ended the session
+            conn.close()
+            conn = None
+        if conn is not None:
+            return (conn, True)
+        answer = self.connect()
+        if type(answer) is bytes:
+            return answer
+        return (answer, False)
+
     def send_cmd(self, *cmd):
         """Send a command to server
 
         *cmd are arbitary byte strings
 
         """
-        if self.keyfile is not None:
-            with open(self.keyfile, 'rb') as keyfile:
-                key = keyfile.read()
-        else:
-            key = b''
-        if self.password is None:
-            password = b''
+
+        auth = self.get_auth()
+        if type(auth) is bytes:
+            return auth
+        answer = self.request(*auth, *cmd)
+        if answer == INVALID_TOKEN:
+            # The token expired or the password was changed; the next
+            # one is tried only once
+            self.token = None
+            auth = self.get_auth()
+            if type(auth) is bytes:
+                return auth
+            answer = self.request(*auth, *cmd)
+        return answer
+
+    def request(self, *parts):
+        """Send a request and receive the answer
+
+        The session is reused if there is one. If it broke the request is
+        sent again on a new connection, unless the server may have
+        executed a command which changes the database already.
+
+        """
+
+        answer = self.get_connection()
+        if type(answer) is bytes:
+            return answer
+        conn, reused = answer
+        try:
+            conn.send(*parts)
+        except OSError:
+            conn.close()
+            if reused is True:
+                # The session timed out, the request didn't arrive whole
+                return self.request(*parts)
+            raise
+        try:
+            answer = conn.receive()
+            self.save_tls_session(conn)
+        except OSError:
+            conn.close()
+            if reused is True and parts[2] in IDEMPOTENT_COMMANDS:
+                # The session timed out before the request arrived
+                return self.request(*parts)
+            raise
+
+        if conn.session is True:
+            self.conn = conn
         else:
-            password = self.password.encode()
+            conn.close()
+        return answer
+
+    def pipeline(self, *cmds):
+        """Send several commands at once
+
+        *cmds are tuples of byte strings like the arguments of send_cmd.
+        The answers are returned in the same order. If the server doesn't
+        support pipelining the commands are sent one after another.
 
-        tmp = [password, key]
-        tmp.extend(cmd)
-        cmd_chain = build_message(tmp)
+        """
 
+        if not cmds:
+            return []
+        # The first command opens the session and shows what the server
+        # supports
+        answers = [self.send_cmd(*cmds[0])]
+        if self.conn is None or self.conn.pipelined is False:
+            for i in cmds[1:]:
+                answers.append(self.send_cmd(*i))
+            return answers
+
+        auth = self.get_auth()
+        if type(auth) is bytes:
+            return answers + [auth] * (len(cmds) - 1)
+        conn = self.conn
+        self.conn = None
+        answers.extend([None] * (len(cmds) - 1))
+        # Request ids are the indices of the answers
+        pending = 0
         try:
-            tmp_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            for request_id in range(1, len(cmds)):
+                if pending == PIPELINE_WINDOW:
+                    answer = conn.receive()
+                    answers[conn.request_id] = answer
+                    pending -= 1
+                conn.send(*auth, *cmds[request_id],
+                          request_id = request_id)
+                pending += 1
+            while pending > 0:
+                answer = conn.receive()
+                answers[conn.request_id] = answer
+                pending -= 1
+        except OSError:
+            conn.close()
+            raise
+
+        self.conn = conn
+        # The token expired while the commands were sent
+        for i in range(1, len(cmds)):
+            if answers[i] == INVALID_TOKEN:
+                answers[i] = self.send_cmd(*cmds[i])
+        return answers
+
+    def save_tls_session(self, conn):
+        """Remember the TLS session of conn for the next connection
+
+        With TLS 1.3 the session ticket arrives after the handshake, so
+        this is done after an answer was received.
+
+        """
+
+        if self.context is not None and conn.sock.session is not None:
+            tls_sessions[(self.tls_dir, self.server_address)] = \
+                conn.sock.session
+
+    def close(self):
+        """Close the session if there is one"""
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def connect(self):
+        """Connect to the server
+
+        Returns a Connection which uses framing if the server supports it
+        or a FAIL message if the TLS checks failed.
+
+        """
+
+        legacy = self.server_address in legacy_servers
+        try:
+            tmp_conn = new_socket(self.server_address)
             if self.context is not None:
-                conn = self.context.wrap_socket(tmp_conn)
+                session = tls_sessions.get((self.tls_dir,
+                                            self.server_address))
+                conn = self.context.wrap_socket(tmp_conn, session = session)
             else:
                 conn = tmp_conn
             conn.connect(self.server_address)
         except:
             raise
         else:
-            logging.info('Connected to '+self.server_address[0]+':'+
-                         str(self.server_address[1]))
+            logging.info('Connected to '+peer_name(conn))
         try:
             conn.settimeout(60)
             if self.context is not None:
-                if not isfile(self.tls_dir + '/pin'):
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
+                sha = sha256()
+                sha.update(conn.getpeercert(True))
+                pinned_key = get_tls_pin(self.tls_dir)
+                if pinned_key is None:
                     with open(self.tls_dir + '/pin', 'wb') as pin:
                         pin.write(sha.digest())
-                else:
-                    with open(self.tls_dir + '/pin', 'rb') as pin:
-                        pinned_key = pin.read()
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    if pinned_key != sha.digest():
-                        return (b'FAIL: Server certificate differs from '
-                                b'pinned certificate')
+                    tls_pins[self.tls_dir] = sha.digest()
+                elif pinned_key != sha.digest():
+                    conn.shutdown(socket.SHUT_RDWR)
+                    conn.close()
+                    return (b'FAIL: Server certificate differs from '
+                            b'pinned certificate')
                 cert = conn.getpeercert()
                 try:
                     ssl.match_hostname(cert, "KeePassC Server")
                 except:
+                    conn.shutdown(socket.SHUT_RDWR)
+                    conn.close()
                     return b'FAIL: TLS - Hostname does not match'
-            sendmsg(conn, cmd_chain)
-            answer = receive(conn)
+            connection = Connection(conn, traffic = self.traffic,
+                                    spool_limit = SPOOL_LIMIT)
+            if legacy is False:
+                capabilities = [FRAMED]
+                if self.session is True:
+                    capabilities.extend((SESSION, RID))
+                if self.compression is not None:
+                    capabilities.append(self.compression)
+                if self.token is not False:
+                    capabilities.append(CHALLENGE)
+                accepted = connection.negotiate(*capabilities)
         except:
-            raise
-        finally:
-            conn.shutdown(socket.SHUT_RDWR)
             conn.close()
+            raise
 
-        return answer
+        if legacy is False and accepted is None:
+            # Old server which closed the connection after our hello
+            conn.close()
+            legacy_servers.add(self.server_address)
+            return self.connect()
+        return connection
 
     def get_bytes(self, cmd, *misc):
         """Send a command and get the answer as bytes
@@ -128,7 +434,8 @@ class Client(object):
         """Send a command and get the answer decoded"""
 
         try:
-            answer = self.send_cmd(cmd, *misc).decode()
+            # A spooled answer is an mmap, which has no decode()
+            answer = str(self.send_cmd(cmd, *misc), 'utf-8')
             if answer[:4] == b'FAIL':
                 raise OSError(answer)
             return answer
@@ -141,6 +448,49 @@ class Client(object):
 
         return self.get_string(b'FIND', title)
 
+    def find_fields(self, title, *fields):
+        """Find entries by title and get only some of their fields
+
+        fields are names of ENTRY_FIELDS like b'password'; without them
+        all fields are requested. Returns a list with a dict per entry
+        which maps the field names to strings or None.
+
+        """
+
+        try:
+            answer = self.send_cmd(b'FINDF', title, *fields)
+            if answer[:4] == b'FAIL':
+                raise OSError(answer.decode())
+            if not fields:
+                fields = ENTRY_FIELDS
+            names = [i.decode() for i in fields]
+            entries = []
+            for record in unpack_records(answer):
+                entry = {}
+                for name, value in zip(names, record):
+                    if value is not None:
+                        value = value.decode()
+                    entry[name] = value
+                entries.append(entry)
+            return entries
+        except (OSError, TypeError, ValueError) as err:
+            logging.error(err.__str__())
+            return err.__str__()
+
+    def find_many(self, *titles):
+        """Find entries for several titles with pipelined requests
+
+        Returns a list with the answer for every title.
+
+        """
+
+        try:
+            answers = self.pipeline(*[(b'FIND', i) for i in titles])
+            return [str(i, 'utf-8') for i in answers]
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+            return [err.__str__()] * len(titles)
+
     def get_db(self):
         """Just get the whole encrypted database from server"""
 
@@ -2,11 +2,135 @@
 
 Functions:
     build_message(parts)
-    receive(conn)
+    receive(conn, max_size, deadline)
     sendmsg(sock, msg)
+    sendall_vectored(sock, buffers, timeout)
+    wait_writable(sock, deadline)
+    wait_readable(sock, deadline)
+    new_traffic()
+    compress(compression, level, buffers)
+    get_decompressor(compression)
+    decompress(compression, data, max_size)
+    pack_records(records, fields)
+    unpack_records(buf)
+    socket_path(name)
+    peer_name(sock)
+    peer_credentials(sock)
+    listen_unix(path, backlog)
+    inherited_sockets()
+    new_socket(address)
+    open_connection(address)
+
+Classes:
+    MessageTooLarge(OSError)
+    ServerBusy(OSError)
+    Spool(object)
+    Connection(object)
+    AsyncConnection(Connection)
+    Reply(object)
 """
 
+import asyncio
+import concurrent.futures
 import logging
+import lzma
+import mmap
+import os
+import select
+import socket
+import ssl
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+BREAK = b'\xB2\xEA\xC0'
+DEAD_END = b'\xDE\xAD\xE1\x1D'
+
+# A hello starts with a byte no password or command starts with and
+# lists the capabilities of the sender separated by spaces, e.g.
+#
+# b'\x00KPC FRAMED'
+#
+# Old peers don't understand it and close the connection or answer with
+# a FAIL message
+HELLO = b'\x00KPC'
+FRAMED = b'FRAMED'
+# Keep the connection open for further requests
+SESSION = b'SESSION'
+# Tag messages with request ids so that requests can be pipelined and
+# answered in any order
+RID = b'RID'
+# Compress messages with zlib or lzma. The level may be appended, e.g.
+# b'ZLIB=9'; each peer compresses what it sends with that level.
+ZLIB = b'ZLIB'
+LZMA = b'LZMA'
+COMPRESSIONS = (ZLIB, LZMA)
+# The server takes challenge responses instead of credentials for LOGIN
+CHALLENGE = b'CHALLENGE'
+
+# Answer of a server which can't take another client at the moment. It's
+# sent in legacy mode before the hello is read.
+BUSY = b'FAIL: busy'
+
+# A request whose password is TOKEN carries a session token from LOGIN
+# instead of the keyfile. It isn't valid UTF-8, so no password looks like
+# it. Tokens which expired or were revoked are answered with INVALID_TOKEN.
+TOKEN = b'\xFF'
+INVALID_TOKEN = b'FAIL: Invalid token'
+# A request whose password is RESPONSE and whose keyfile is empty asks for
+# a challenge: the seeds and rounds of the key transformation and a nonce.
+# With a keyfile of the nonce and the HMAC of the nonce with the final key,
+# separated by a colon, it's authenticated by that response.
+RESPONSE = b'\xFE'
+
+# In framed mode every message is preceded by its length and, if RID was
+# negotiated, by the id of the request
+HEADER = struct.Struct('!I')
+RID_HEADER = struct.Struct('!II')
+# The highest bit of the length marks a compressed message
+COMPRESSED = 1 << 31
+
+# Smaller messages are never compressed
+MIN_COMPRESS = 256
+# Bigger messages are only compressed if a sample of this size shrinks,
+# so that encrypted databases aren't compressed in vain
+SAMPLE_SIZE = 4096
+
+# Fields of an entry which can be requested with FINDF
+ENTRY_FIELDS = (b'title', b'url', b'username', b'password', b'creation',
+                b'last_access', b'last_mod', b'expire', b'comment')
+# A list of records starts with the number of records and fields, every
+# field with its length or NONE
+RECORDS_HEADER = struct.Struct('!IH')
+FIELD_HEADER = struct.Struct('!I')
+NONE = 0xFFFFFFFF
+
+# Receive buffers up to this size are reused for the next message
+REUSE_LIMIT = 1 << 20
+
+# Connections with a spool limit write bigger messages to a temporary file
+# in chunks of SPOOL_CHUNK bytes instead of holding them in memory
+SPOOL_LIMIT = 1 << 24
+SPOOL_CHUNK = 1 << 16
+
+# Local peers may use Unix domain sockets in the data directory instead
+# of TCP. Addresses which are strings are paths of such sockets.
+SERVER_SOCKET = 'server.sock'
+AGENT_SOCKET = 'agent.sock'
+# Credentials of the peer of a Unix domain socket: pid, uid and gid
+PEERCRED = struct.Struct('3i')
+
+# First file descriptor of sockets passed by a service manager like
+# systemd, their number is in LISTEN_FDS
+LISTEN_FDS_START = 3
+
+# Smaller buffers are joined if they can't be sent with socket.sendmsg
+COPY_LIMIT = 1 << 16
+
+# Maximum number of buffers for one socket.sendmsg call
+IOV_MAX = 1024
 
 
 def build_message(parts):
@@ -22,43 +146,59 @@ def build_message(parts):
 
     """
 
-    msg = b''
-    for i in parts[:-1]:
-        msg += i
-        msg += b'\xB2\xEA\xC0' # \xB2\xEA\xC0 = BREAK
-    msg += parts[-1]
+    # \xB2\xEA\xC0 = BREAK
+    return BREAK.join(parts)
 
-    return msg
+class MessageTooLarge(OSError):
+    """Raised if a message exceeds the maximum size of the receiver"""
+
+    pass
 
-def receive(conn):
+class ServerBusy(OSError):
+    """Raised if the server rejected the connection because it's busy"""
+
+    pass
+
+def receive(conn, max_size = None, deadline = None):
     """Receive a message
 
     conn has to be the socket which receive the message
 
     A message has to end with the bytestring  b'\xDE\xAD\xE1\x1D'
-    
+
+    If max_size is given MessageTooLarge is raised as soon as more data
+    was received. If deadline is given the message has to be received
+    by then, see wait_readable.
+
     """
 
-    ip, port = conn.getpeername()
-    logging.info('Receiving a message from '+ip+':'+str(port))
-    data = b''
+    peer = peer_name(conn)
+    logging.info('Receiving a message from '+peer)
+    data = bytearray()
     while True:
         try:
-            received = conn.recv(16)
+            wait_readable(conn, deadline)
+            received = conn.recv(4096)
             if not received:
                 logging.error("No data received")
                 break
         except:
             raise
-        if b'\xDE\xAD\xE1\x1D' in received:
-            data += received[:received.find(b'\xDE\xAD\xE1\x1D')]
+        # Only the new chunk and the last three bytes before it
+        # could contain the terminator
+        start = max(len(data) - 3, 0)
+        data += received
+        end = data.find(DEAD_END, start)
+        if end != -1:
+            del data[end:]
             break
-        else:
-            data += received
-            if data[-4:] == b'\xDE\xAD\xE1\x1D':
-                data = data[:-4]
-                break
-    return data
+        if max_size is not None and len(data) > max_size + len(DEAD_END):
+            raise MessageTooLarge('Message from '+peer+
+                                  ' exceeds '+str(max_size)+' bytes')
+    if max_size is not None and len(data) > max_size:
+        raise MessageTooLarge('Message from '+peer+
+                              ' exceeds '+str(max_size)+' bytes')
+    return bytes(data)
 
 def sendmsg(sock, msg):
     """Send message
@@ -69,11 +209,974 @@ def sendmsg(sock, msg):
 
     """
 
-    ip, port = sock.getpeername()
     try:
-        logging.info('Send a message to '+ip+':'+str(port))
+        logging.info('Send a message to '+peer_name(sock))
         # \xDE\xAD\xE1\x1D = DEAD END
-        sock.sendall(msg + b'\xDE\xAD\xE1\x1D')
+        sendall_vectored(sock, (msg, DEAD_END))
+    except:
+        raise
+
+def sendall_vectored(sock, buffers, timeout = None):
+    """Send a list of buffers without joining them
+
+    Plain sockets use scatter/gather I/O. TLS sockets don't support it,
+    so small buffers are joined there while big ones are sent as they are.
+
+    If timeout is given, sending all buffers may take at most that many
+    seconds, else socket.timeout is raised. Otherwise only the timeout
+    of the socket limits every single call.
+
+    """
+
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    else:
+        deadline = None
+
+    if isinstance(sock, ssl.SSLSocket):
+        pending = []
+        for i in buffers:
+            if len(i) < COPY_LIMIT:
+                pending.append(i)
+                continue
+            if pending:
+                wait_writable(sock, deadline)
+                sock.sendall(b''.join(pending))
+                pending = []
+            wait_writable(sock, deadline)
+            sock.sendall(i)
+        if pending:
+            wait_writable(sock, deadline)
+            sock.sendall(b''.join(pending))
+        return
+
+    views = [memoryview(i) for i in buffers if len(i) > 0]
+    first = 0
+    while first < len(views):
+        wait_writable(sock, deadline)
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        # Skip everything that was sent and keep the rest of a partially
+        # sent buffer
+        while sent > 0:
+            if sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            else:
+                views[first] = views[first][sent:]
+                sent = 0
+
+def wait_writable(sock, deadline):
+    """Wait until sock can be written to or raise socket.timeout
+
+    deadline is a time.monotonic() value, None means no deadline.
+
+    """
+
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not select.select([], [sock], [], remaining)[1]:
+        raise socket.timeout('Sending to '+peer_name(sock)+' timed out')
+
+def wait_readable(sock, deadline):
+    """Wait until sock can be read from or raise socket.timeout
+
+    deadline is a time.monotonic() value, None means no deadline.
+
+    """
+
+    if deadline is None:
+        return
+    if isinstance(sock, ssl.SSLSocket) and sock.pending() > 0:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+        raise socket.timeout('Receiving from '+peer_name(sock)+
+                             ' timed out')
+
+def new_traffic():
+    """Get a dict to count the traffic of connections"""
+
+    return {'sent': 0, 'received': 0, 'payload_sent': 0,
+            'payload_received': 0}
+
+def compress(compression, level, buffers):
+    """Compress buffers with zlib or lzma
+
+    Returns a list of compressed chunks or None if compression isn't
+    worth it.
+
+    """
+
+    largest = max(buffers, key = len)
+    if len(largest) > SAMPLE_SIZE:
+        sample = largest[:SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > len(sample) * 0.9:
+            return None
+
+    if level is None:
+        level = 6
+    if compression == ZLIB:
+        compressor = zlib.compressobj(level)
+    else:
+        compressor = lzma.LZMACompressor(preset = level)
+    chunks = [compressor.compress(i) for i in buffers]
+    chunks.append(compressor.flush())
+    chunks = [i for i in chunks if len(i) > 0]
+    if sum(len(i) for i in chunks) >= sum(len(i) for i in buffers):
+        return None
+    return chunks
+
+def get_decompressor(compression):
+    """Get a zlib or lzma decompressor object"""
+
+    if compression == ZLIB:
+        return zlib.decompressobj()
+    elif compression == LZMA:
+        return lzma.LZMADecompressor()
+    else:
+        raise OSError('Received a compressed message without compression')
+
+def decompress(compression, data, max_size = None):
+    """Decompress a message
+
+    MessageTooLarge is raised if the result would exceed max_size.
+
+    """
+
+    decompressor = get_decompressor(compression)
+    if max_size is None:
+        msg = decompressor.decompress(data)
+    elif compression == ZLIB:
+        msg = decompressor.decompress(data, max_size + 1)
+    else:
+        msg = decompressor.decompress(data, max_length = max_size + 1)
+    if max_size is not None and len(msg) > max_size:
+        raise MessageTooLarge('Decompressed message exceeds '+str(max_size)+
+                              ' bytes')
+    if decompressor.eof is False:
+        raise OSError('Received a truncated compressed message')
+    return msg
+
+def pack_records(records, fields):
+    """Pack records of bytestrings
+
+    records is a list of tuples with one bytestring or None per field.
+    Every field is preceded by its length so the values may contain any
+    bytes.
+
+    """
+
+    buf = bytearray(RECORDS_HEADER.pack(len(records), fields))
+    for record in records:
+        for i in record:
+            if i is None:
+                buf += FIELD_HEADER.pack(NONE)
+            else:
+                buf += FIELD_HEADER.pack(len(i))
+                buf += i
+    return buf
+
+def unpack_records(buf):
+    """Unpack records packed by pack_records"""
+
+    view = memoryview(buf)
+    records = []
+    try:
+        count, fields = RECORDS_HEADER.unpack_from(view)
+        offset = RECORDS_HEADER.size
+        for i in range(count):
+            record = []
+            for j in range(fields):
+                length = FIELD_HEADER.unpack_from(view, offset)[0]
+                offset += FIELD_HEADER.size
+                if length == NONE:
+                    record.append(None)
+                    continue
+                if offset + length > len(view):
+                    raise struct.error('field exceeds the message')
+                record.append(bytes(view[offset:offset + length]))
+                offset += length
+            records.append(tuple(record))
+    except struct.error as err:
+        raise ValueError('Received broken records: '+err.__str__())
+    return records
+
+def socket_path(name):
+    """Get the path of a Unix domain socket in the data directory"""
+
+    datapath = os.getenv('XDG_DATA_HOME')
+    if datapath is None:
+        datapath = '~/.local/share'
+    return os.path.join(os.path.realpath(os.path.expanduser(datapath)),
+                        'keepassc', name)
+
+def peer_name(sock):
+    """Describe the peer of a socket for log messages"""
+
+    try:
+        peer = sock.getpeername()
+    except OSError:
+        return 'unknown peer'
+    if type(peer) is tuple:
+        return peer[0]+':'+str(peer[1])
+    elif peer:
+        # Path of the socket of a server or an agent
+        return peer
+    # Clients of Unix domain sockets are unnamed
+    credentials = peer_credentials(sock)
+    if credentials is None:
+        return 'local process'
+    return 'local process '+str(credentials[0])
+
+def peer_credentials(sock):
+    """Get pid, uid and gid of the peer of a Unix domain socket
+
+    Returns None if the system doesn't support SO_PEERCRED.
+
+    """
+
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                  PEERCRED.size)
+    return PEERCRED.unpack(credentials)
+
+def listen_unix(path, backlog):
+    """Listen on a Unix domain socket only the user may connect to
+
+    The socket of a former run is replaced.
+
+    """
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Nobody else may connect, even for a moment
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
     except:
+        sock.close()
         raise
+    finally:
+        os.umask(umask)
+    sock.listen(backlog)
+    return sock
+
+def inherited_sockets():
+    """Get the listening sockets passed by a service manager
+
+    The sockets are taken over if LISTEN_PID is the pid of this process,
+    the variables are removed so that children don't take them too. An
+    empty list is returned if no sockets were passed.
+
+    """
+
+    try:
+        pid = int(os.environ.pop('LISTEN_PID', ''))
+        count = int(os.environ.pop('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    finally:
+        os.environ.pop('LISTEN_FDNAMES', None)
+    if pid != os.getpid():
+        return []
+    socks = []
+    for fd in range(LISTEN_FDS_START, LISTEN_FDS_START + count):
+        os.set_inheritable(fd, False)
+        socks.append(socket.socket(fileno=fd))
+    return socks
+
+def new_socket(address):
+    """Create a socket which can connect to address
+
+    address is a tuple of host and port or the path of a Unix domain
+    socket.
+
+    """
+
+    if type(address) is str:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+def open_connection(address):
+    """Open a plain connection to a server or an agent
+
+    Framing is negotiated; if the peer is too old to understand the
+    hello, it's connected again in legacy mode.
+
+    """
+
+    sock = new_socket(address)
+    sock.settimeout(60)
+    sock.connect(address)
+    conn = Connection(sock)
+    try:
+        accepted = conn.negotiate(FRAMED)
+    except:
+        sock.close()
+        raise
+    if accepted is None:
+        sock.close()
+        sock = new_socket(address)
+        sock.settimeout(60)
+        sock.connect(address)
+        conn = Connection(sock)
+    return conn
+
+
+class Spool(object):
+    """A received message which is written to a temporary file
+
+    The payload is written in chunks and, if it's compressed, decompressed
+    on the way. finish() returns a read-only mmap of the file, so the
+    message is held by the page cache instead of the heap.
+
+    """
+
+    def __init__(self, compression = None, max_size = None):
+        self.file = tempfile.TemporaryFile()
+        if compression is None:
+            self.decompressor = None
+        else:
+            self.decompressor = get_decompressor(compression)
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        """Write the next chunk of the payload"""
+
+        if self.decompressor is None:
+            self.store(data)
+            return
+        # A small chunk may decompress to a lot, so the output is limited
+        # to SPOOL_CHUNK at a time
+        if isinstance(self.decompressor, lzma.LZMADecompressor):
+            self.store(self.decompressor.decompress(data, SPOOL_CHUNK))
+            while (self.decompressor.needs_input is False and
+                   self.decompressor.eof is False):
+                self.store(self.decompressor.decompress(b'', SPOOL_CHUNK))
+        else:
+            self.store(self.decompressor.decompress(data, SPOOL_CHUNK))
+            while self.decompressor.unconsumed_tail:
+                self.store(self.decompressor.decompress(
+                    self.decompressor.unconsumed_tail, SPOOL_CHUNK))
+
+    def store(self, data):
+        """Append data to the file"""
+
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise MessageTooLarge('Decompressed message exceeds '+
+                                  str(self.max_size)+' bytes')
+        self.file.write(data)
+
+    def finish(self):
+        """Get the message and close the file"""
+
+        try:
+            if (self.decompressor is not None and
+                    self.decompressor.eof is False):
+                raise OSError('Received a truncated compressed message')
+            if self.size == 0:
+                # An empty file can't be mapped
+                return b''
+            self.file.flush()
+            return mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            self.file.close()
+
+    def close(self):
+        """Drop the file of a message which wasn't received completely"""
+
+        self.file.close()
+
+
+class Connection(object):
+    """A socket which speaks the legacy or the framed protocol
+
+    In legacy mode a message ends with b'\xDE\xAD\xE1\x1D'. In framed mode
+    it is preceded by its length instead, so it's read with recv_into
+    into a preallocated buffer and may contain any bytes. Framing is
+    used only if both peers agreed on it with a hello.
+
+    """
+
+    def __init__(self, sock, framed = False, traffic = None,
+                 max_size = None, send_timeout = None,
+                 request_timeout = None, spool_limit = None):
+        self.sock = sock
+        # Bigger messages are rejected, None means no limit
+        self.max_size = max_size
+        # Framed messages which are bigger are spooled, None means never
+        self.spool_limit = spool_limit
+        # Seconds sending a message may take, None means only the timeout
+        # of the socket applies
+        self.send_timeout = send_timeout
+        # Seconds a request may take from its first byte until its answer
+        # is sent and the time.monotonic() by which the current one has
+        # to be answered. None means no limit.
+        self.request_timeout = request_timeout
+        self.deadline = None
+        self.framed = framed
+        self.capabilities = []
+        self.header = bytearray(HEADER.size)
+        self.buf = bytearray()
+        # Id of the last received request
+        self.request_id = 0
+        # Replies of pipelined requests are sent by several threads. A TLS
+        # socket mustn't be used by two threads at once at all, there the
+        # lock is taken for receiving, too.
+        self.io_lock = threading.Lock()
+        # Negotiated compression and its level
+        self.compression = None
+        self.level = None
+        # Bytes on the wire and before compression. Pass the same dict to
+        # several connections to sum them up.
+        if traffic is None:
+            traffic = new_traffic()
+        self.traffic = traffic
+
+    @property
+    def session(self):
+        """True if the connection is kept open for further requests"""
+
+        return self.framed is True and SESSION in self.capabilities
+
+    @property
+    def pipelined(self):
+        """True if messages carry request ids"""
+
+        return self.session is True and RID in self.capabilities
+
+    def set_capabilities(self, capabilities):
+        """Switch to the protocol both peers agreed on"""
+
+        self.capabilities = capabilities
+        self.framed = FRAMED in capabilities
+        if self.pipelined is True:
+            self.header = bytearray(RID_HEADER.size)
+        for i in capabilities:
+            name, sep, level = i.partition(b'=')
+            if self.framed is True and name in COMPRESSIONS:
+                if level != b'' and not level.isdigit():
+                    # A broken hello, nothing is compressed then
+                    break
+                self.compression = name
+                if level != b'':
+                    self.level = min(int(level), 9)
+                break
+
+    def negotiate(self, *capabilities):
+        """Offer capabilities to the server
+
+        Returns the list of capabilities the server accepted or None if
+        the server is too old to understand the hello. In the latter case
+        the connection is useless and has to be closed.
+
+        """
+
+        sendmsg(self.sock, b' '.join((HELLO,) + capabilities))
+        answer = receive(self.sock)
+        if answer == BUSY:
+            # An old server would have answered with a wrong password
+            raise ServerBusy(BUSY.decode())
+        words = answer.split(b' ')
+        if words[0] != HELLO:
+            return None
+        self.set_capabilities(words[1:])
+        return self.capabilities
+
+    def receive_first(self, *capabilities):
+        """Receive the first message of a connection
+
+        If the client starts with a hello, the offered capabilities which
+        are also in capabilities are acknowledged and the next message is
+        returned instead.
+
+        """
+
+        self.begin_request()
+        msg = receive(self.sock, self.max_size, self.deadline)
+        if not msg.startswith(HELLO):
+            return msg
+        sendmsg(self.sock, self.accept_hello(msg, capabilities))
+        return self.receive()
+
+    def accept_hello(self, msg, capabilities):
+        """Accept the offered capabilities which are in capabilities
+
+        Returns the hello which has to be sent back in legacy mode.
+
+        """
+
+        offered = msg.split(b' ')[1:]
+        accepted = []
+        for i in offered:
+            name, sep, level = i.partition(b'=')
+            if name in capabilities and (level == b'' or level.isdigit()):
+                accepted.append(i)
+        self.set_capabilities(accepted)
+        return b' '.join([HELLO] + accepted)
+
+    def receive(self):
+        """Receive a message
+
+        The id of a pipelined request is stored in request_id. A message
+        bigger than REUSE_LIMIT is returned as the bytearray it was
+        received into, one bigger than spool_limit as the mmap of a Spool.
+
+        """
+
+        self.begin_request()
+        if self.framed is False:
+            msg = receive(self.sock, self.max_size, self.deadline)
+            self.traffic['received'] += len(msg) + len(DEAD_END)
+            self.traffic['payload_received'] += len(msg)
+            return msg
+
+        length, compressed = self.receive_header()
+        if self.spool_limit is not None and length > self.spool_limit:
+            return self.receive_spooled(length, compressed)
+        if length > REUSE_LIMIT:
+            # Copying a big message would double the memory it takes, it
+            # gets a buffer of its own which is returned
+            buf = bytearray(length)
+            self.recv_exactly(memoryview(buf))
+            return self.decode(buf, compressed)
+        if length > len(self.buf):
+            self.buf = bytearray(length)
+        view = memoryview(self.buf)[:length]
+        self.recv_exactly(view)
+        return self.decode(view, compressed)
+
+    def receive_spooled(self, length, compressed):
+        """Receive a framed payload of length bytes into a Spool"""
+
+        if compressed:
+            spool = Spool(self.compression, self.max_size)
+        else:
+            spool = Spool()
+        if len(self.buf) < SPOOL_CHUNK:
+            self.buf = bytearray(SPOOL_CHUNK)
+        left = length
+        try:
+            while left > 0:
+                view = memoryview(self.buf)[:min(left, SPOOL_CHUNK)]
+                self.recv_exactly(view)
+                spool.write(view)
+                left -= len(view)
+        except:
+            spool.close()
+            raise
+        msg = spool.finish()
+        self.traffic['received'] += len(self.header) + length
+        self.traffic['payload_received'] += len(msg)
+        return msg
+
+    def decode(self, payload, compressed):
+        """Get the message out of a received framed payload
+
+        payload is a view of the reused buffer, which is copied, or a
+        buffer of its own, which is returned as it is.
+
+        """
+
+        self.traffic['received'] += len(self.header) + len(payload)
+        if compressed:
+            msg = decompress(self.compression, payload, self.max_size)
+        elif isinstance(payload, memoryview):
+            # The buffer is overwritten by the next message
+            msg = bytes(payload)
+        else:
+            msg = payload
+        self.traffic['payload_received'] += len(msg)
+        return msg
+
+    def begin_request(self):
+        """Wait for the next message and start its deadline
+
+        The timeout of the socket limits the wait, request_timeout the
+        time from then until the answer is sent.
+
+        """
+
+        self.deadline = None
+        if self.request_timeout is None:
+            return
+        if self.buffered() is False:
+            if not select.select([self.sock], [], [],
+                                 self.sock.gettimeout())[0]:
+                raise socket.timeout('No request from '+
+                                     peer_name(self.sock))
+        self.deadline = time.monotonic() + self.request_timeout
+
+    def expired(self):
+        """Check if the deadline of the current request has passed"""
+
+        return (self.deadline is not None and
+                time.monotonic() >= self.deadline)
+
+    def timeout(self, deadline):
+        """Get the seconds sending may take until deadline"""
+
+        if deadline is None:
+            return self.send_timeout
+        remaining = max(deadline - time.monotonic(), 0)
+        if self.send_timeout is None:
+            return remaining
+        return min(self.send_timeout, remaining)
+
+    def receive_header(self):
+        """Receive the header of a framed message
+
+        Returns the length of the message and whether it's compressed.
+        A message which is too large is rejected before it's received.
+
+        """
+
+        self.recv_exactly(memoryview(self.header))
+        return self.parse_header()
+
+    def parse_header(self):
+        """Get length and compression of a message from its header"""
+
+        if self.pipelined is True:
+            length, self.request_id = RID_HEADER.unpack(self.header)
+        else:
+            length = HEADER.unpack(self.header)[0]
+        compressed = (length & COMPRESSED) != 0
+        length &= ~COMPRESSED
+        if self.max_size is not None and length > self.max_size:
+            raise MessageTooLarge('Announced message of '+str(length)+
+                                  ' bytes exceeds '+str(self.max_size)+
+                                  ' bytes')
+        return (length, compressed)
+
+    def buffered(self):
+        """Check if a TLS socket holds decrypted data which wasn't read"""
+
+        if not isinstance(self.sock, ssl.SSLSocket):
+            return False
+        with self.io_lock:
+            return self.sock.pending() > 0
+
+    def recv_exactly(self, view):
+        """Fill view completely with received data"""
+
+        while view:
+            if not isinstance(self.sock, ssl.SSLSocket):
+                wait_readable(self.sock, self.deadline)
+                received = self.sock.recv_into(view)
+            else:
+                # Replies are sent while the data is awaited, the lock is
+                # taken only to read it
+                self.wait_tls()
+                with self.io_lock:
+                    received = self.sock.recv_into(view)
+            if not received:
+                raise OSError('Connection closed by peer')
+            view = view[received:]
+
+    def wait_tls(self):
+        """Wait until a TLS socket can be read from
+
+        The timeout of the socket and the deadline apply, socket.timeout
+        is raised when they passed.
+
+        """
+
+        if self.buffered() is True:
+            return
+        timeout = self.sock.gettimeout()
+        if self.deadline is not None:
+            remaining = max(self.deadline - time.monotonic(), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        if not select.select([self.sock], [], [], timeout)[0]:
+            raise socket.timeout('Receiving from '+peer_name(self.sock)+
+                                 ' timed out')
+
+    def send(self, *parts, request_id = None, deadline = None):
+        """Send a message
+
+        parts are bytestrings which are seperated by BREAK like
+        build_message does, but they are never copied into one message.
+
+        On a pipelined connection the message is tagged with request_id
+        or, if it's None, with the id of the last received request.
+        Sending has to be done by deadline or, if it's None, by the one
+        of the current request.
+
+        """
+
+        if deadline is None:
+            deadline = self.deadline
+        buffers = self.frame(parts, request_id)
+        with self.io_lock:
+            sendall_vectored(self.sock, buffers, self.timeout(deadline))
+
+    def frame(self, parts, request_id):
+        """Get the buffers which make up a message on the wire"""
+
+        buffers = []
+        for i in parts:
+            buffers.append(i)
+            buffers.append(BREAK)
+        buffers.pop()
+
+        logging.info('Send a message to '+peer_name(self.sock))
+        length = sum(len(i) for i in buffers)
+        self.traffic['payload_sent'] += length
+        if self.framed is False:
+            buffers.append(DEAD_END)
+        else:
+            flags = 0
+            if self.compression is not None and length >= MIN_COMPRESS:
+                compressed = compress(self.compression, self.level, buffers)
+                if compressed is not None:
+                    buffers = compressed
+                    length = sum(len(i) for i in buffers)
+                    flags = COMPRESSED
+            if self.pipelined is True:
+                if request_id is None:
+                    request_id = self.request_id
+                buffers.insert(0, RID_HEADER.pack(length | flags, request_id))
+            else:
+                buffers.insert(0, HEADER.pack(length | flags))
+        self.traffic['sent'] += sum(len(i) for i in buffers)
+        return buffers
+
+    def is_closed(self):
+        """Check if an idle connection was closed by the peer
+
+        A peer never sends anything unrequested, so an idle connection
+        that is readable got an EOF or a reset.
+
+        """
+
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+    def close(self):
+        """Shutdown and close the socket"""
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class AsyncConnection(Connection):
+    """A Connection on asyncio streams
+
+    Messages are received with coroutines in the event loop. send() is
+    meant for handlers which run in an executor: it hands the message to
+    the event loop and waits until it's written. In the event loop
+    send_async() has to be used instead.
+
+    """
+
+    def __init__(self, reader, writer, loop, traffic = None,
+                 max_size = None, send_timeout = None,
+                 request_timeout = None, spool_limit = None):
+        Connection.__init__(self, writer.get_extra_info('socket'),
+                            False, traffic, max_size, send_timeout,
+                            request_timeout, spool_limit)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        # Messages which threads are waiting to be written. They're
+        # cancelled on close(), the event loop may stop before it writes
+        # them. io_lock guards them.
+        self.sends = set()
+        self.closed = False
+
+    async def begin_request_async(self, first):
+        """Start the deadline of a message once first bytes of it arrived
+
+        Returns the first bytes.
+
+        """
+
+        self.deadline = None
+        data = await first
+        if self.request_timeout is not None:
+            self.deadline = time.monotonic() + self.request_timeout
+        return data
+
+    async def until_deadline(self, awaitable):
+        """Await a read which has to be done by the deadline"""
+
+        if self.deadline is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(
+                awaitable, max(self.deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise socket.timeout('Receiving from '+peer_name(self.sock)+
+                                 ' timed out')
+
+    async def receive_legacy(self):
+        """Receive a message which ends with DEAD_END"""
+
+        try:
+            first = await self.begin_request_async(
+                self.reader.readexactly(1))
+            msg = first + await self.until_deadline(
+                self.reader.readuntil(DEAD_END))
+        except asyncio.IncompleteReadError as err:
+            # Like receive() return what was sent before the EOF
+            if err.expected == 1:
+                msg = DEAD_END
+            else:
+                msg = first + err.partial + DEAD_END
+        except asyncio.LimitOverrunError:
+            raise MessageTooLarge('Message from '+peer_name(self.sock)+
+                                  ' exceeds '+str(self.max_size)+' bytes')
+        self.traffic['received'] += len(msg)
+        self.traffic['payload_received'] += len(msg) - len(DEAD_END)
+        return msg[:-len(DEAD_END)]
+
+    async def receive_first_async(self, *capabilities):
+        """Receive the first message like receive_first()"""
+
+        msg = await self.receive_legacy()
+        if not msg.startswith(HELLO):
+            return msg
+        await self.write((self.accept_hello(msg, capabilities), DEAD_END),
+                         self.deadline)
+        return await self.receive_async()
+
+    async def receive_async(self):
+        """Receive a message like receive()"""
+
+        if self.framed is False:
+            return await self.receive_legacy()
+        try:
+            self.header[:] = await self.begin_request_async(
+                self.reader.readexactly(len(self.header)))
+            length, compressed = self.parse_header()
+            if self.spool_limit is not None and length > self.spool_limit:
+                return await self.until_deadline(
+                    self.receive_spooled_async(length, compressed))
+            data = await self.until_deadline(self.reader.readexactly(length))
+        except asyncio.IncompleteReadError:
+            raise OSError('Connection closed by peer')
+        return self.decode(data, compressed)
+
+    async def receive_spooled_async(self, length, compressed):
+        """Receive a framed payload into a Spool like receive_spooled()"""
+
+        if compressed:
+            spool = Spool(self.compression, self.max_size)
+        else:
+            spool = Spool()
+        left = length
+        try:
+            while left > 0:
+                data = await self.reader.readexactly(min(left, SPOOL_CHUNK))
+                spool.write(data)
+                left -= len(data)
+        except:
+            spool.close()
+            raise
+        msg = spool.finish()
+        self.traffic['received'] += len(self.header) + length
+        self.traffic['payload_received'] += len(msg)
+        return msg
+
+    async def write(self, buffers, deadline = None):
+        """Write buffers and wait until they're flushed by deadline"""
+
+        self.writer.writelines(buffers)
+        try:
+            await asyncio.wait_for(self.writer.drain(),
+                                   self.timeout(deadline))
+        except asyncio.TimeoutError:
+            err = socket.timeout('Sending to '+peer_name(self.sock)+
+                                 ' timed out')
+            # The unsent data would stay in the buffer
+            self.writer.transport.abort()
+            raise err
+
+    async def send_async(self, *parts, request_id = None, deadline = None):
+        """Send a message from the event loop"""
+
+        if deadline is None:
+            deadline = self.deadline
+        await self.write(self.frame(parts, request_id), deadline)
+
+    def send(self, *parts, request_id = None, deadline = None):
+        """Send a message from a thread which isn't the event loop
+
+        OSError is raised if the connection is or gets closed before the
+        message is written.
+
+        """
+
+        if deadline is None:
+            deadline = self.deadline
+        buffers = self.frame(parts, request_id)
+        with self.io_lock:
+            if self.closed is True:
+                raise OSError('Connection was closed')
+            future = asyncio.run_coroutine_threadsafe(
+                self.write(buffers, deadline), self.loop)
+            self.sends.add(future)
+        try:
+            future.result()
+        except concurrent.futures.CancelledError:
+            raise OSError('Connection was closed before sending')
+        finally:
+            with self.io_lock:
+                self.sends.discard(future)
+
+    def close(self):
+        """Close the stream and cancel the messages which wait for it"""
+
+        with self.io_lock:
+            self.closed = True
+            for i in self.sends:
+                i.cancel()
+        self.writer.close()
+
+
+class Reply(object):
+    """Answers one request of a pipelined connection
+
+    Handlers get a Reply instead of the Connection so that they don't
+    have to care about request ids.
+
+    """
+
+    def __init__(self, conn, request_id):
+        self.conn = conn
+        self.request_id = request_id
+        # The connection goes on with the next request meanwhile
+        self.deadline = conn.deadline
+
+    def expired(self):
+        """Check if the deadline of the request has passed"""
+
+        return (self.deadline is not None and
+                time.monotonic() >= self.deadline)
+
+    def send(self, *parts):
+        """Send the answer"""
+
+        self.conn.send(*parts, request_id = self.request_id,
+                       deadline = self.deadline)
+
+    async def send_async(self, *parts):
+        """Send the answer from the event loop of an AsyncConnection"""
 
+        await self.conn.send_async(*parts, request_id = self.request_id,
+                                   deadline = self.deadline)
@@ -2,13 +2,15 @@
 
 import curses as cur
 import logging
+import threading
+import time
 from curses.ascii import NL, DEL, SP
 from datetime import date, datetime
 from os import chdir, getcwd, getenv, geteuid, makedirs, remove
-from os.path import expanduser, isfile, isdir, realpath, join
+from os.path import exists, expanduser, isfile, isdir, realpath, join
 from pwd import getpwuid
 from random import sample
-from socket import gethostname, socket, AF_INET, SOCK_STREAM, SHUT_RDWR
+from socket import gethostname, SHUT_RDWR
 from sys import exit
 
 from kppy.database import KPDBv1
@@ -17,7 +19,7 @@ from kppy.exceptions import KPError
 from keepassc.conn import *
 from keepassc.client import Client
 from keepassc.editor import Editor
-from keepassc.helper import parse_config, write_config
+from keepassc.helper import parse_config, write_config, watch_transform
 from keepassc.filebrowser import FileBrowser
 from keepassc.dbbrowser import DBBrowser
 
@@ -158,6 +160,71 @@ class Control(object):
         finally:
             self.stdscr.refresh()
 
+    def run_keyed(self, changed, text, db, func, *args):
+        '''Run func, which transforms the key of db, in a thread
+
+        text is shown with the rounds done and the time left until func
+        returns, so the screen keeps being redrawn. F5 cancels the
+        transformation and func raises KPError then. Exceptions of func
+        are raised here.
+
+        '''
+
+        progress = [0, 0]
+        cancel = threading.Event()
+        db._transform_key = watch_transform(db, progress, cancel)
+        result = []
+
+        def run():
+            try:
+                result.append((True, func(*args)))
+            except Exception as err:
+                result.append((False, err))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        start = time.time()
+        thread.start()
+        leave = False
+        self.stdscr.timeout(100)
+        try:
+            while thread.is_alive():
+                done, rounds = progress
+                if done > 0:
+                    left = (time.time() - start) * (rounds - done) / done
+                    state = ('{0}/{1} rounds, {2:.0f} seconds left'
+                             .format(done, rounds, left))
+                else:
+                    state = 'Transforming the key'
+                if cancel.is_set():
+                    state = 'Cancelling'
+                self.draw_text(changed,
+                               (1, 0, text),
+                               (3, 0, state),
+                               (5, 0, 'Type \'F5\' to cancel.'))
+                try:
+                    e = self.stdscr.getch()
+                except KeyboardInterrupt:
+                    e = 4
+                if e == 4:
+                    leave = True
+                    cancel.set()
+                elif e == cur.KEY_F5:
+                    cancel.set()
+                elif e == cur.KEY_RESIZE:
+                    self.resize_all()
+        finally:
+            self.stdscr.timeout(-1)
+            # A database which is saved is never left half written
+            thread.join()
+            del db._transform_key
+        if leave is True:
+            self.close()
+        ok, value = result[0]
+        if ok is False:
+            raise value
+        return value
+
     def draw_help(self, *text):
         """Draw a help
 
@@ -1095,7 +1162,8 @@ class Control(object):
             else:
                 read_only = False
             self.db = KPDBv1(self.cur_dir, password, keyfile, read_only)
-            self.db.load()
+            self.run_keyed(False, 'Opening the database', self.db,
+                           self.db.load)
             return True
         except KPError as err:
             self.draw_text(False,
@@ -1117,17 +1185,20 @@ class Control(object):
             use_agent = 2
 
         if use_agent == 1:
-            port = self.get_num("Agent port: ", "50001", 5)
-            if port is False:
-                return False
-            elif port == -1:
-                self.close()
+            # A local agent may listen on a Unix domain socket instead
+            # of a port
+            agent_address = socket_path(AGENT_SOCKET)
+            if not exists(agent_address):
+                port = self.get_num("Agent port: ", "50001", 5)
+                if port is False:
+                    return False
+                elif port == -1:
+                    self.close()
+                agent_address = ('localhost', port)
 
-            sock = socket(AF_INET, SOCK_STREAM)
-            sock.settimeout(60)
             try:
-                sock.connect(('localhost', port))
-                sendmsg(sock, build_message((b'GET',)))
+                conn = open_connection(agent_address)
+                conn.send(b'GET')
             except OSError as err:
                 self.draw_text(False, (1, 0, err.__str__()),
                                       (3, 0, "Press any key."))
@@ -1135,7 +1206,7 @@ class Control(object):
                     self.close()
                 return False
 
-            db_buf = receive(sock)
+            db_buf = conn.receive()
             if db_buf[:4] == b'FAIL' or db_buf[:4] == b'[Err':
                 self.draw_text(False,
                                (1, 0, db_buf),
@@ -1143,14 +1214,12 @@ class Control(object):
                 if self.any_key() == -1:
                     self.close()
                 return False
-            sock.shutdown(SHUT_RDWR)
-            sock.close()
+            conn.sock.shutdown(SHUT_RDWR)
+            conn.sock.close()
 
-            sock = socket(AF_INET, SOCK_STREAM)
-            sock.settimeout(60)
             try:
-                sock.connect(('localhost', port))
-                sendmsg(sock, build_message((b'GETC',)))
+                conn = open_connection(agent_address)
+                conn.send(b'GETC')
             except OSError as err:
                 self.draw_text(False, (1, 0, err.__str__()),
                                       (3, 0, "Press any key."))
@@ -1158,7 +1227,7 @@ class Control(object):
                     self.close()
                 return False
 
-            answer = receive(sock)
+            answer = conn.receive()
             parts = answer.split(b'\xB2\xEA\xC0')
             password = parts.pop(0).decode()
             keyfile_cont = parts.pop(0).decode()
@@ -1265,7 +1334,16 @@ class Control(object):
                     self.close()
                 return False
         self.db = KPDBv1(None, password, keyfile)
-        self.db.load(db_buf)
+        try:
+            self.run_keyed(False, 'Opening the remote database', self.db,
+                           self.db.load, db_buf)
+        except KPError as err:
+            self.draw_text(False,
+                           (1, 0, err.__str__()),
+                           (4, 0, 'Press any key.'))
+            if self.any_key() == -1:
+                self.close()
+            return False
         db = DBBrowser(self, True, server, port, ssl, tls_dir)
         del db
         return True
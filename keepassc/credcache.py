@@ -0,0 +1,92 @@
+"""This module caches credentials which were verified.
+
+Checking credentials transforms the key with all rounds of the database.
+Clients which send the same credentials again are looked up instead.
+
+Classes:
+    CredentialCache(object)
+"""
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class CredentialCache(object):
+    """Remember verified credentials for ttl seconds
+
+    Entries are keyed by a salted hash of the password, the keyfile, the
+    peer and the server's own key, so neither credentials nor anything
+    which could be checked without the salt are kept. A change of the
+    server's credentials makes all entries miss. At most size entries
+    are kept, the least recently used one is dropped first. A ttl or a
+    size of 0 turns the cache off.
+
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.salt = os.urandom(32)
+        self.lock = threading.Lock()
+        # Expiry times by digest, the least recently used first
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0,
+                      'flushed': 0}
+
+    def digest(self, password, keyfile, peer, own_key):
+        """Get the key of an entry, password and keyfile are bytes"""
+
+        mac = hmac.new(self.salt, digestmod = 'sha256')
+        for i in (password, keyfile, peer.encode(), own_key):
+            # Hashing every part first keeps their borders apart
+            mac.update(hashlib.sha256(i).digest())
+        return mac.digest()
+
+    def lookup(self, password, keyfile, peer, own_key):
+        """Check if the credentials were verified for peer"""
+
+        if self.ttl <= 0 or self.size <= 0:
+            return False
+        digest = self.digest(password, keyfile, peer, own_key)
+        with self.lock:
+            expiry = self.entries.get(digest)
+            if expiry is None:
+                self.stats['misses'] += 1
+                return False
+            if expiry <= time.monotonic():
+                del self.entries[digest]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return False
+            self.entries.move_to_end(digest)
+            self.stats['hits'] += 1
+            return True
+
+    def add(self, password, keyfile, peer, own_key):
+        """Remember credentials which were verified for peer"""
+
+        if self.ttl <= 0 or self.size <= 0:
+            return
+        digest = self.digest(password, keyfile, peer, own_key)
+        with self.lock:
+            self.entries[digest] = time.monotonic() + self.ttl
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+                self.stats['evicted'] += 1
+
+    def flush(self):
+        """Forget all credentials"""
+
+        with self.lock:
+            self.stats['flushed'] += len(self.entries)
+            self.entries.clear()
+
+    def get_stats(self):
+        """Get a copy of the counters"""
+
+        with self.lock:
+            return dict(self.stats, entries = len(self.entries))
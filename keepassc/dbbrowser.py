@@ -68,6 +68,7 @@ class DBBrowser(object):
         self.port = port
         self.ssl = ssl
         self.tls_dir = tls_dir
+        self.remote_client = None
 
         self.control.show_groups(self.g_highlight, self.groups,
                                  self.cur_win, self.g_offset,
@@ -143,11 +144,10 @@ class DBBrowser(object):
 
         self.remove_results()
         self.sort_tables(True, False)
-        self.control.draw_text(False,
-                               (1, 0, 'Do not interrupt or '
-                                'your file will break!'))
         try:
-            self.db.save(cur_dir)
+            self.control.run_keyed(False, 'Do not interrupt or your file '
+                                   'will break!', self.db, self.db.save,
+                                   cur_dir)
         except KPError as err:
             self.control.draw_text(False,
                                    (1, 0, err.__str__()),
@@ -245,6 +245,9 @@ class DBBrowser(object):
                                        (1, 0, err.__str__()),
                                        (4, 0, 'Press any key.'))
                 self.control.any_key()
+        if self.remote_client is not None:
+            self.remote_client.close()
+            self.remote_client = None
         self.db = None
         self.control.db = None
 
@@ -313,8 +316,18 @@ class DBBrowser(object):
                 db_buf = self.client().get_db()
                 if self.check_answer(db_buf) is False:
                     return False
-            self.db = KPDBv1(None, self.db.password, self.db.keyfile)
-            self.db.load(db_buf)
+            db = KPDBv1(None, self.db.password, self.db.keyfile)
+            try:
+                self.control.run_keyed(self.changed, 'Loading the changed '
+                                       'database', db, db.load, db_buf)
+            except KPError as err:
+                self.control.draw_text(self.changed,
+                                       (1, 0, err.__str__()),
+                                       (4, 0, 'Press any key.'))
+                if self.control.any_key() == -1:
+                    self.close()
+                return False
+            self.db = db
             self.control.db = self.db
 
             # This loop has to be executed _before_ sort_tables is called
@@ -411,7 +424,9 @@ class DBBrowser(object):
             db_buf = None
 
         try:
-            self.db.unlock(password, keyfile, db_buf)
+            self.control.run_keyed(self.changed, 'Unlocking the database',
+                                   self.db, self.db.unlock, password,
+                                   keyfile, db_buf)
         except KPError as err:
             self.control.draw_text(self.changed,
                                    (1, 0, err.__str__()),
@@ -1201,11 +1216,24 @@ class DBBrowser(object):
                 self.changed = True
 
     def client(self):
-        return Client(logging.ERROR, 'client.log', 
-                      self.address, 
-                      self.port, self.db.password, 
-                      self.db.keyfile, self.ssl, 
-                      self.tls_dir)
+        '''Get a client for the remote database
+
+        The client is reused as long as the credentials don't change so
+        that its session to the server stays open.
+
+        '''
+
+        if (self.remote_client is None or
+                self.remote_client.password != self.db.password or
+                self.remote_client.keyfile != self.db.keyfile):
+            if self.remote_client is not None:
+                self.remote_client.close()
+            self.remote_client = Client(logging.ERROR, 'client.log', 
+                                        self.address, 
+                                        self.port, self.db.password, 
+                                        self.db.keyfile, self.ssl, 
+                                        self.tls_dir, True)
+        return self.remote_client
 
     def check_answer(self, answer):
         if answer[:4] == 'FAIL' or answer[:4] == "[Err":
@@ -6,6 +6,11 @@ from os.path import isdir, isfile
 
 from Cryptodome.Hash import SHA256
 from Cryptodome.Cipher import AES
+from kppy.exceptions import KPError
+
+# Rounds of the key transformation which are done at once, see
+# stretch_key
+TRANSFORM_CHUNK = 1 << 16
 
 def parse_config(control):
     '''Parse the config file.
@@ -70,21 +75,71 @@ def write_config(control, config):
 def transform_key(masterkey, seed1, seed2, rounds):
     """This method creates the key to decrypt the database"""
 
-    if masterkey is None or seed1 is None or seed2 is None or rounds is None:
-        raise TypeError('None type not allowed')
-    aes = AES.new(seed1, AES.MODE_ECB)
+    return get_final_key(stretch_key(masterkey, seed1, rounds), seed2)
+
+def stretch_key(masterkey, seed1, rounds, progress = None):
+    """This method encrypts masterkey rounds times and hashes it
+
+    It's the expensive part of transform_key. The result doesn't depend on
+    the second seed, which changes whenever the database is saved.
+
+    Encrypting a block again and again is the same as encrypting zeros in
+    CBC mode with the block as IV, so the rounds are done in chunks of
+    TRANSFORM_CHUNK by the cipher. progress is called with the rounds done
+    after every chunk.
 
-    # Encrypt the created hash
-    for i in range(rounds):
-        masterkey = aes.encrypt(masterkey)
+    """
+
+    if masterkey is None or seed1 is None or rounds is None:
+        raise TypeError('None type not allowed')
+    # Both halves of the key are encrypted separately like in ECB mode
+    blocks = [masterkey[i:i + 16] for i in range(0, len(masterkey), 16)]
+    zeros = bytes(16 * min(rounds, TRANSFORM_CHUNK))
+    done = 0
+    while done < rounds:
+        count = min(rounds - done, TRANSFORM_CHUNK)
+        blocks = [AES.new(seed1, AES.MODE_CBC, i).encrypt(
+                      zeros[:16 * count])[-16:] for i in blocks]
+        done += count
+        if progress is not None:
+            progress(done)
+    masterkey = b''.join(blocks)
 
     # Finally, hash it again...
     sha_obj = SHA256.new()
     sha_obj.update(masterkey)
-    masterkey = sha_obj.digest()
-    # ...and hash the result together with the randomseed
+    return sha_obj.digest()
+
+def watch_transform(db, progress, cancel):
+    """Get a replacement for the key transformation of db
+
+    Set it as db._transform_key before db is loaded, unlocked or saved.
+    progress is a list of the rounds done and all rounds which is updated
+    while the key is transformed. If the event cancel is set the
+    transformation stops with a KPError.
+
+    """
+
+    def step(done):
+        progress[0] = done
+        if cancel.is_set():
+            raise KPError('Cancelled')
+
+    def transform(masterkey):
+        progress[:] = [0, db._key_transf_rounds]
+        stretched = stretch_key(masterkey, db._transf_randomseed,
+                                db._key_transf_rounds, step)
+        return get_final_key(stretched, db._final_randomseed)
+
+    return transform
+
+def get_final_key(stretched, seed2):
+    """This method hashes a stretched key together with the randomseed"""
+
+    if stretched is None or seed2 is None:
+        raise TypeError('None type not allowed')
     sha_obj = SHA256.new()
-    sha_obj.update(seed2 + masterkey)
+    sha_obj.update(seed2 + stretched)
     return sha_obj.digest()
 
 def get_passwordkey(key):
@@ -0,0 +1,145 @@
+"""This module implements a fair reader/writer lock.
+
+Classes:
+    RWLock(object)
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class RWLock(object):
+    """A reader/writer lock which grants access in FIFO order
+
+    Any number of readers may hold the lock at the same time, a writer
+    holds it alone. Waiting threads are woken up in the order they came:
+    a writer waits for the readers before it and readers which come after
+    a waiting writer wait for it, so neither side can starve. Waiting
+    threads sleep on an event of their own which is set by the thread
+    releasing the lock.
+
+    The time readers and writers wait is recorded in stats.
+
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.readers = 0
+        self.writer = False
+        # Waiting threads as lists of [is writer, event]
+        self.queue = deque()
+        self.stats = {'read': self.new_stats(), 'write': self.new_stats()}
+
+    @staticmethod
+    def new_stats():
+        """Get zeroed wait statistics"""
+
+        return {'acquired': 0, 'waited': 0, 'wait_time': 0.0,
+                'max_wait': 0.0}
+
+    def record(self, kind, waited):
+        """Record the seconds a reader or writer waited, mutex is held"""
+
+        stats = self.stats[kind]
+        stats['acquired'] += 1
+        if waited > 0:
+            stats['waited'] += 1
+            stats['wait_time'] += waited
+            if waited > stats['max_wait']:
+                stats['max_wait'] = waited
+
+    def get_stats(self):
+        """Get a copy of the wait statistics"""
+
+        with self.mutex:
+            return {'read': dict(self.stats['read']),
+                    'write': dict(self.stats['write'])}
+
+    def acquire_read(self):
+        """Acquire the lock for reading"""
+
+        with self.mutex:
+            if self.writer is False and not self.queue:
+                self.readers += 1
+                self.record('read', 0)
+                return
+            waiter = [False, threading.Event()]
+            self.queue.append(waiter)
+            start = time.perf_counter()
+        waiter[1].wait()
+        waited = time.perf_counter() - start
+        with self.mutex:
+            self.record('read', waited)
+
+    def release_read(self):
+        """Release the lock after reading"""
+
+        with self.mutex:
+            self.readers -= 1
+            if self.readers == 0:
+                self.wake()
+
+    def acquire_write(self):
+        """Acquire the lock for writing"""
+
+        with self.mutex:
+            if (self.writer is False and self.readers == 0 and
+                    not self.queue):
+                self.writer = True
+                self.record('write', 0)
+                return
+            waiter = [True, threading.Event()]
+            self.queue.append(waiter)
+            start = time.perf_counter()
+        waiter[1].wait()
+        waited = time.perf_counter() - start
+        with self.mutex:
+            self.record('write', waited)
+
+    def release_write(self):
+        """Release the lock after writing"""
+
+        with self.mutex:
+            self.writer = False
+            self.wake()
+
+    def wake(self):
+        """Hand the lock to the next waiting threads, mutex is held
+
+        A writer at the head of the queue gets the lock alone, else all
+        readers up to the next writer get it.
+
+        """
+
+        while self.queue and self.writer is False:
+            is_writer, event = self.queue[0]
+            if is_writer is True:
+                if self.readers == 0:
+                    self.queue.popleft()
+                    self.writer = True
+                    event.set()
+                return
+            self.queue.popleft()
+            self.readers += 1
+            event.set()
+
+    @contextmanager
+    def reading(self):
+        """Hold the lock for reading in a with statement"""
+
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        """Hold the lock for writing in a with statement"""
+
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -1,48 +1,129 @@
 """This file implements the server daemon.
 
-Decorator:
-    class waitDecorator(object)
+Decorators:
+    writer(func)
 
 Classes:
     class Server(Connection, Daemon)
+    Snapshot(version, entries, data)
 """
 
+import asyncio
+import functools
+import hmac
 import logging
+import os
+import queue
+import select
+import selectors
+import shutil
 import signal
 import socket
 import ssl
+import struct
 import sys
-import time
+import tempfile
 import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from os import chdir
-from os.path import join, expanduser, realpath
+from errno import EBADF, EINVAL
+from os import chdir, getuid, remove
+from os.path import basename, dirname, join, expanduser, realpath
 
 from kppy.database import KPDBv1
 from kppy.exceptions import KPError
 
+from keepassc.admission import Admission
 from keepassc.conn import *
+from keepassc.credcache import CredentialCache
 from keepassc.daemon import Daemon
-from keepassc.helper import get_key, transform_key
-
-class waitDecorator(object):
-    def __init__(self, func):
-        self.func = func
-        self.lock = False
+from keepassc.helper import get_final_key, get_key, stretch_key
+from keepassc.rwlock import RWLock
+
+# Commands which don't change the database. Worker processes of the
+# prefork mode handle them, all others are forwarded to the writer.
+READ_COMMANDS = (b'FIND', b'FINDF', b'GET', b'LOGIN')
+
+# Seconds a client may take to answer a challenge
+CHALLENGE_LIFETIME = 60
+
+# Seconds a new client may take to start sending its first request
+FIRST_REQUEST_TIMEOUT = 60
+
+# Standard limits for the arguments of a command in bytes
+COMMAND_LIMITS = {
+    b'FIND': 4096,
+    b'FINDF': 4096,
+    b'GET': 0,
+    b'LOGIN': 0,
+    b'DELG': 4096,
+    b'DELE': 4096,
+    b'MOVG': 4096,
+    b'MOVE': 4096,
+    b'TITG': 65536,
+    b'TITE': 65536,
+    b'USER': 65536,
+    b'URL': 65536,
+    b'PASS': 65536,
+    b'DATE': 4096}
+
+# How often a worker process tries to load a changed database
+RELOAD_ATTEMPTS = 3
+
+# Sent by worker processes to the writer, which keeps the nonces that
+# were used in any process
+USE_NONCE = b'\x00NONCE'
+
+# What lookups see of the database: the entries as tuples of their fields
+# and the saved file. A new snapshot replaces the old one after every
+# change, so readers never need the database lock.
+Snapshot = namedtuple('Snapshot', ('version', 'entries', 'data'))
+SnapshotEntry = namedtuple('SnapshotEntry',
+                           [i.decode() for i in ENTRY_FIELDS])
+
+def writer(func):
+    """Run a handler while holding the database lock alone
+
+    The handler returns its answer, which is sent after the lock was
+    released, so a slow client doesn't hold up other writers. A change
+    whose deadline passed while waiting for the lock isn't made.
+
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, conn, parts):
+        with self.db_lock.writing():
+            if conn.expired():
+                # The client doesn't wait for the answer anymore
+                raise socket.timeout('Deadline passed before '+
+                                     func.__name__)
+            answer = func(self, conn, parts)
+        conn.send(answer)
+    return wrapper
+
+class Session(object):
+    """A connection which is kept open for further requests
+
+    Between its requests a session is parked. The requests of a
+    pipelined session are handled while the next one is received.
+
+    """
+
+    def __init__(self, conn, client):
+        self.conn = conn
+        self.client = client
+        self.lock = threading.Lock()
+        # Requests which are being handled
+        self.running = 0
+        # Set while the next request waits for a running one to finish
+        self.waiting = False
+        # Set if a request failed, nothing is received anymore then
+        self.failed = False
+        # Set once nothing is received anymore
+        self.ended = False
 
-    def __get__(self, obj, type=None):
-        return self.__class__(self.func.__get__(obj, type))
-
-    def __call__(self, *args):
-        while True:
-            if self.lock == True:
-                time.sleep(1)
-                continue
-            else:
-                self.lock = True
-                self.func(args[0], args[1])
-                self.lock = False
-                break
 
 class Server(Daemon):
     """The KeePassC server daemon"""
@@ -50,8 +131,18 @@ class Server(Daemon):
     def __init__(self, pidfile, loglevel, logfile, address = None,
                  port = 50002, db = None, password = None, keyfile = None,
                  tls = False, tls_dir = None, tls_port = 50003,
-                 tls_req = False):
+                 tls_req = False, idle_timeout = 300,
+                 max_request = 1 << 20, unix_socket = None,
+                 engine = 'threads', workers = 16, queue_depth = 64,
+                 processes = 1, send_timeout = 60, drain_timeout = 10,
+                 auth_concurrency = 16, auth_rate = 5, auth_burst = 20,
+                 request_timeout = 60, idle_exit = 0,
+                 token_lifetime = 300, cache_ttl = 300, cache_size = 1024,
+                 command_limits = None, max_pipeline = 16):
         Daemon.__init__(self, pidfile)
+        # Startup takes most of its time to transform the key, it's
+        # logged to see what an on-demand start costs
+        self.started = time.monotonic()
 
         try:
             logdir = realpath(expanduser(getenv('XDG_DATA_HOME')))
@@ -81,15 +172,25 @@ class Server(Daemon):
         chdir("/var/empty")
 
         try:
+            # The key of the server's own credentials is needed for every
+            # authentication, it's stretched once while loading
+            self.key_cache = None
+            self.stretched_keys = {}
             self.db = KPDBv1(self.db_path, password, keyfile)
+            self.db._transform_key = self.cached_transform(self.db)
             self.db.load()
-        except KPError as err:
+            with open(self.db_path, 'rb') as handler:
+                self.snapshot = self.make_snapshot(self.db, handler.read(), 0)
+        except (KPError, OSError) as err:
             print(err)
             logging.error(err.__str__())
             sys.exit(1)
+        logging.info('Loaded the database in {0:.3f} seconds'
+                     .format(time.monotonic() - self.started))
 
         self.lookup = {
             b'FIND': self.find,
+            b'FINDF': self.find_fields,
             b'GET': self.send_db,
             b'CHANGESECRET': self.change_password,
             b'NEWG': self.create_group,
@@ -106,9 +207,117 @@ class Server(Daemon):
             b'PASS': self.set_e_pass,
             b'DATE': self.set_e_exp}
 
+        # After LOGIN a client sends a token instead of its credentials,
+        # which is checked without transforming the key. Tokens are valid
+        # for token_lifetime seconds, 0 turns LOGIN off.
+        self.token_lifetime = token_lifetime
+        if token_lifetime > 0:
+            self.lookup[b'LOGIN'] = self.login
+        # Tokens are signed with a key derived from this secret and the
+        # server's own key, so changing the password revokes all of them
+        self.token_secret = os.urandom(32)
+        # Clients may log in with the response to a challenge instead of
+        # their credentials; they transform the key themselves then. A
+        # nonce is valid for CHALLENGE_LIFETIME seconds and only once.
+        # The secret is shared by all processes of the prefork mode, so
+        # tokens and nonces are valid in any of them.
+        self.capabilities = (FRAMED, SESSION, RID, ZLIB, LZMA)
+        if token_lifetime > 0:
+            self.capabilities += (CHALLENGE,)
+        # Expiry times of the used nonces; in the prefork mode only the
+        # writer's are used
+        self.used_nonces = {}
+
+        # Seconds a session may wait for its next request
+        self.idle_timeout = idle_timeout
+        # Every authentication costs a full key transformation, so peers
+        # are limited in how many they may run
+        self.admission = Admission(auth_concurrency, auth_rate, auth_burst)
+        # Credentials which were verified are looked up instead of checked
+        # again; a hit skips admission, too
+        self.cred_cache = CredentialCache(cache_ttl, cache_size)
+        # Number and seconds of the key checks
+        self.auth_stats = {'checked': 0, 'failed': 0, 'auth_time': 0.0,
+                           'max_auth_time': 0.0, 'tokens': 0,
+                           'invalid_tokens': 0}
+        # Seconds sending an answer may take before the client is dropped
+        self.send_timeout = send_timeout
+        # Seconds a request may take from its first byte until it's
+        # answered. Work for requests which are late is skipped.
+        self.request_timeout = request_timeout
+        # Requests of one pipelined session which are handled in parallel
+        self.max_pipeline = max_pipeline
+        # Handlers which change the database run alone and in the order
+        # they came. Lookups read the snapshot, which is replaced at once,
+        # so they don't take it.
+        self.db_lock = RWLock()
+        # Bytes sent and received by all connections
+        self.traffic = new_traffic()
+        # Biggest request in bytes, bigger ones are rejected
+        self.max_request = max_request
+        # Biggest arguments of a command in bytes; commands which
+        # aren't listed may use the whole request
+        self.limits = dict(COMMAND_LIMITS)
+        if command_limits is not None:
+            self.limits.update(command_limits)
+
+        # 'threads' handles every connection in a thread of its own,
+        # 'asyncio' handles all of them in one event loop and runs only
+        # the handlers in a thread pool
+        self.engine = engine
+        self.loop = None
+        self.stopping = None
+        # Clients are handled by a fixed number of workers. At most
+        # queue_depth clients wait for one, further ones are rejected.
+        self.workers = workers
+        self.queue_depth = queue_depth
+        # Parked sessions are queued again without a limit, so the depth
+        # is checked when a client is accepted
+        self.clients = queue.Queue()
+        # Sessions waiting for their next request don't keep a worker,
+        # they are parked until they are readable again. The watcher is
+        # woken up through wakeup to take the new ones. New clients wait
+        # the same way for their first request in arriving.
+        self.parked = []
+        self.arriving = []
+        self.park_lock = threading.Lock()
+        self.wakeup = None
+        # Requests the asyncio engine passed to its executor
+        self.pending = 0
+        self.pool_lock = threading.Lock()
+        self.pool_stats = {'accepted': 0, 'rejected': 0, 'max_queued': 0,
+                           'expired': 0}
+
+        # With several processes the first one only changes the database
+        # and the others handle the clients
+        self.processes = processes
+        # Pids of the worker processes, set in the writer
+        self.children = None
+        # Connection to the writer, set in a worker process
+        self.writer_conn = None
+        self.writer_lock = threading.Lock()
+        # Connections which tell the workers to reload the database
+        self.events = []
+        self.events_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        # On SIGTERM no new requests are accepted and the running ones get
+        # drain_timeout seconds to finish
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.drain_start = None
+        self.in_flight = 0
+        self.requests_done = threading.Condition()
+        # Without a request for idle_exit seconds the server stops itself,
+        # 0 keeps it running
+        self.idle_exit = idle_exit
+        self.last_active = time.monotonic()
+
         self.sock = None
         self.net_sock = None
         self.tls_sock = None
+        self.unix_sock = None
+        self.unix_socket = unix_socket
         self.tls_req = tls_req
 
         if tls is True or tls_req is True:
@@ -116,14 +325,37 @@ class Server(Daemon):
             cert = join(tls_dir, "servercert.pem")
             key = join(tls_dir, "serverkey.pem")
             self.context.load_cert_chain(certfile=cert, keyfile=key)
+            # Clients resume their sessions with tickets or from the
+            # session cache of the context instead of a full handshake
+            self.context.options &= ~ssl.OP_NO_TICKET
         else:
             self.context = None
 
+        # A service manager like systemd may have bound the sockets
+        # already and starts the server on the first connection
+        self.inherited = inherited_sockets()
+        if self.inherited:
+            self.adopt_sockets(tls_port)
+        else:
+            self.bind_sockets(address, port, tls_port, unix_socket)
+        if (self.sock is None and self.unix_sock is None and
+                (self.net_sock is None or self.tls_req is True) and
+                (self.tls_sock is None or self.context is None)):
+            print('No socket to listen on')
+            logging.error('No socket to listen on')
+            sys.exit(1)
+
+        #Handle SIGTERM
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        signal.signal(signal.SIGHUP, self.handle_sighup)
+        signal.signal(signal.SIGUSR1, self.handle_sigusr1)
+
+    def bind_sockets(self, address, port, tls_port, unix_socket):
+        """Create the listening sockets"""
+
         try:
             # Listen for commands
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.bind(("localhost", 50000))
-            self.sock.listen(5)
+            self.sock = self.listen_tcp("localhost", 50000)
         except OSError as err:
             print(err)
             logging.error(err.__str__())
@@ -134,9 +366,7 @@ class Server(Daemon):
         if self.tls_req is False and address is not None:
             try:
                 # Listen for commands
-                self.net_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.net_sock.bind((address, port))
-                self.net_sock.listen(5)
+                self.net_sock = self.listen_tcp(address, port)
             except OSError as err:
                 print(err)
                 logging.error(err.__str__())
@@ -148,9 +378,7 @@ class Server(Daemon):
         if self.context is not None and address is not None:
             try:
                 # Listen for commands
-                self.tls_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.tls_sock.bind((address, tls_port))
-                self.tls_sock.listen(5)
+                self.tls_sock = self.listen_tcp(address, tls_port)
             except OSError as err:
                 print(err)
                 logging.error(err.__str__())
@@ -159,45 +387,498 @@ class Server(Daemon):
                 logging.info('TLS-Server socket created on '+address+':'+
                              str(tls_port))
 
+        if unix_socket is not None:
+            try:
+                # Listen for commands of local clients
+                self.unix_sock = listen_unix(unix_socket, 5)
+            except OSError as err:
+                print(err)
+                logging.error(err.__str__())
+                sys.exit(1)
+            else:
+                logging.info('Server socket created on '+unix_socket)
+
+    def adopt_sockets(self, tls_port):
+        """Use the inherited sockets instead of binding new ones
+
+        A Unix domain socket is used for local clients, a TCP socket on
+        tls_port for TLS if it's enabled and one on localhost:50000 as the
+        local socket. Any other socket is the socket for the network.
+
+        """
+
+        for sock in self.inherited:
+            if sock.family == socket.AF_UNIX:
+                self.unix_sock = sock
+                # The socket file belongs to the service manager
+                self.unix_socket = None
+            elif (self.context is not None and
+                      sock.getsockname()[1] == tls_port):
+                self.tls_sock = sock
+            elif sock.getsockname()[:2] == ('127.0.0.1', 50000):
+                self.sock = sock
+            else:
+                self.net_sock = sock
+            # The service manager keeps its copy listening, so the sockets
+            # aren't shut down on SIGTERM; the accept loops poll them to
+            # notice that they were closed
+            sock.settimeout(1)
+            logging.info('Inherited socket on '+str(sock.getsockname()))
+
+    @staticmethod
+    def make_snapshot(db, data, version):
+        """Get a Snapshot of db, data is the saved file"""
+
+        entries = tuple(SnapshotEntry(*[getattr(i, name) for name in
+                                        SnapshotEntry._fields])
+                        for i in db.entries)
+        return Snapshot(version, entries, data)
+
+    def commit(self):
+        """Save the database, publish a new snapshot and get the file
+
+        The caller holds the database lock for writing.
+
+        """
+
+        # The old file is replaced by a new one, so worker processes never
+        # read a half-written database
+        fd, path = tempfile.mkstemp(prefix='.'+basename(self.db_path)+'.',
+                                    dir=dirname(self.db_path))
+        os.close(fd)
+        try:
+            shutil.copymode(self.db_path, path)
+            self.db.save(path)
+            with open(path, 'rb') as handler:
+                data = handler.read()
+            os.replace(path, self.db_path)
+        except:
+            remove(path)
+            raise
+        self.snapshot = self.make_snapshot(self.db, data,
+                                           self.snapshot.version + 1)
+        return data
+
+    def listen_tcp(self, address, port):
+        """Create a listening TCP socket
 
-        #Handle SIGTERM
-        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        In prefork mode every worker process binds a socket of its own to
+        the same address, so the kernel spreads the connections over them.
+
+        """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.processes > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((address, port))
+        sock.listen(5)
+        return sock
 
     def check_password(self, password, keyfile):
-        """Check received password"""
+        """Check received password
+
+        The stretched keys are compared instead of the final keys. The
+        final key only adds the seed which changes with every save, so
+        the result is the same and a concurrent save can't get between.
+
+        """
 
+        # A worker process may swap in a reloaded database meanwhile
+        db = self.db
+        start = time.perf_counter()
         master = get_key(password, keyfile, True)
-        remote_final =  transform_key(master, self.db._transf_randomseed,
-                                      self.db._final_randomseed,
-                                      self.db._key_transf_rounds)
-        master = get_key(self.db.password, self.db.keyfile)
-        final =  transform_key(master, self.db._transf_randomseed,
-                               self.db._final_randomseed,
-                               self.db._key_transf_rounds)
-        return (remote_final == final)
+        remote = stretch_key(master, db._transf_randomseed,
+                             db._key_transf_rounds)
+        authenticated = hmac.compare_digest(remote, self.own_key(db))
+        self.count_auth(time.perf_counter() - start, authenticated)
+        return authenticated
+
+    def own_key(self, db):
+        """Get the stretched key of the credentials of db
+
+        The key is cached until the credentials or the key derivation
+        change, i.e. after CHANGESECRET or a reload with other credentials.
+
+        """
+
+        params = (db.password, db.keyfile, db._transf_randomseed,
+                  db._key_transf_rounds)
+        cached = self.key_cache
+        if cached is None or cached[0] != params:
+            cached = (params, self.stretched_key(get_key(params[0],
+                                                         params[1]),
+                                                 params[2], params[3]))
+            self.key_cache = cached
+        return cached[1]
+
+    def stretched_key(self, masterkey, seed, rounds):
+        """Get masterkey stretched with seed and rounds
+
+        The last two keys are kept: the one the database is encrypted with
+        and, if there's a keyfile, the one of own_key(). kppy uses keyfiles
+        of 32 or 64 bytes as they are, get_key() hashes them like remote
+        keyfiles.
+
+        """
+
+        params = (masterkey, seed, rounds)
+        stretched = self.stretched_keys.get(params)
+        if stretched is None:
+            stretched = stretch_key(masterkey, seed, rounds)
+            # Replaced instead of changed, other threads may read it
+            keys = dict(list(self.stretched_keys.items())[-1:])
+            keys[params] = stretched
+            self.stretched_keys = keys
+        return stretched
+
+    def cached_transform(self, db):
+        """Get a replacement for the key transformation of db
+
+        It caches the stretched masterkey, so loading and saving db
+        transform the key only if the credentials or the seed changed.
+
+        """
+
+        def transform(masterkey):
+            stretched = self.stretched_key(masterkey, db._transf_randomseed,
+                                           db._key_transf_rounds)
+            return get_final_key(stretched, db._final_randomseed)
+
+        return transform
+
+    def sign_token(self, expiry, peer):
+        """Get the signature of a token for peer which expires at expiry"""
+
+        key = hmac.new(self.token_secret, self.own_key(self.db),
+                       'sha256').digest()
+        return hmac.new(key, expiry+b'.'+peer.encode(),
+                        'sha256').hexdigest().encode()
+
+    def new_token(self, peer):
+        """Get a token for peer
+
+        The token is the expiry time in hex and its signature, both
+        separated by a dot.
+
+        """
+
+        expiry = format(int(time.time()) + self.token_lifetime, 'x').encode()
+        return expiry+b'.'+self.sign_token(expiry, peer)
+
+    def check_token(self, token, peer):
+        """Check a token which peer sent instead of its credentials"""
+
+        try:
+            expiry, signature = token.split(b'.')
+            valid = int(expiry, 16) > time.time()
+        except ValueError:
+            valid = False
+        if valid is True:
+            valid = hmac.compare_digest(self.sign_token(expiry, peer),
+                                        signature)
+        with self.pool_lock:
+            if valid is True:
+                self.auth_stats['tokens'] += 1
+            else:
+                self.auth_stats['invalid_tokens'] += 1
+        return valid
+
+    def count_auth(self, seconds, authenticated):
+        """Count a key check which took seconds"""
+
+        with self.pool_lock:
+            self.auth_stats['checked'] += 1
+            if authenticated is False:
+                self.auth_stats['failed'] += 1
+            self.auth_stats['auth_time'] += seconds
+            if seconds > self.auth_stats['max_auth_time']:
+                self.auth_stats['max_auth_time'] = seconds
 
     def run(self):
         """Overide Daemon.run() and provide socets"""
 
+        if self.processes > 1:
+            self.prefork()
+            return
+        if self.idle_exit > 0:
+            idle_thread = threading.Thread(target=self.watch_idle)
+            idle_thread.daemon = True
+            idle_thread.start()
+        if self.engine == 'asyncio':
+            self.serve_async()
+        else:
+            self.serve_threads()
+            self.log_ready()
+
+    def log_ready(self):
+        """Log how long it took until clients are served"""
+
+        logging.info('Ready after {0:.3f} seconds'
+                     .format(time.monotonic() - self.started))
+
+    def watch_idle(self):
+        """Stop the server after idle_exit seconds without requests
+
+        The server is stopped like by SIGTERM. With socket activation it
+        is started again by the next connection.
+
+        """
+
+        while self.stopped.wait(1) is False:
+            with self.requests_done:
+                idle = (self.in_flight == 0 and
+                        time.monotonic() - self.last_active >= self.idle_exit)
+            if idle is True:
+                logging.info('Idle for '+str(self.idle_exit)+
+                             ' seconds, stopping')
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+    def serve_threads(self):
+        """Start the accepting threads and the workers"""
+
         try:
-            local_thread = threading.Thread(target=self.handle_non_tls,
-                                            args=(self.sock,))
-            local_thread.start()
-            if self.tls_req is False:
+            self.wakeup = socket.socketpair()
+            self.wakeup[1].setblocking(False)
+            watch_thread = threading.Thread(target=self.watch_sessions)
+            watch_thread.daemon = True
+            watch_thread.start()
+            for i in range(self.workers):
+                worker_thread = threading.Thread(target=self.work)
+                worker_thread.daemon = True
+                worker_thread.start()
+            # Inherited sockets may not include all of them
+            if self.sock is not None:
+                local_thread = threading.Thread(target=self.handle_non_tls,
+                                                args=(self.sock,))
+                local_thread.start()
+            if self.tls_req is False and self.net_sock is not None:
                 non_tls_thread = threading.Thread(target=self.handle_non_tls,
                                                   args=(self.net_sock,))
                 non_tls_thread.start()
-            if self.context is not None:
+            if self.context is not None and self.tls_sock is not None:
                 tls_thread = threading.Thread(target=self.handle_tls)
                 tls_thread.start()
+            if self.unix_sock is not None:
+                unix_thread = threading.Thread(target=self.handle_unix)
+                unix_thread.start()
         except OSError as err:
             logging.error(err.__str__())
             self.stop()
 
+    def prefork(self):
+        """Fork the worker processes and become the writer
+
+        Every worker process handles clients like a single server process
+        but forwards commands which change the database to this process.
+        After every change the workers are told to reload the database.
+
+        """
+
+        self.children = set()
+        requests = []
+        for i in range(self.processes):
+            request_pair = socket.socketpair()
+            event_pair = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                for j in requests + [request_pair[0], event_pair[0]]:
+                    j.close()
+                for j in self.events:
+                    j.sock.close()
+                self.serve_worker(request_pair[1], event_pair[1])
+            request_pair[1].close()
+            event_pair[1].close()
+            requests.append(request_pair[0])
+            self.events.append(Connection(event_pair[0], True))
+            self.children.add(pid)
+            logging.info('Started worker process '+str(pid))
+        self.log_ready()
+
+        # Only the workers accept clients
+        for i in (self.sock, self.net_sock, self.tls_sock, self.unix_sock):
+            if i is not None:
+                i.close()
+        self.sock = self.net_sock = self.tls_sock = self.unix_sock = None
+
+        for i in requests:
+            writer_thread = threading.Thread(target=self.serve_writer,
+                                             args=(i,))
+            writer_thread.daemon = True
+            writer_thread.start()
+
+        while self.children:
+            try:
+                pid = os.wait()[0]
+            except ChildProcessError:
+                break
+            self.children.discard(pid)
+            if self.draining is False:
+                logging.error('Worker process '+str(pid)+' died')
+        if self.draining is True:
+            # The workers are gone, so nothing is forwarded anymore
+            self.finish_drain(0)
+
+    def serve_writer(self, sock):
+        """Execute the commands a worker process forwards"""
+
+        conn = Connection(sock, True)
+        while True:
+            try:
+                parts = conn.receive().split(BREAK)
+            except OSError:
+                break
+            cmd = bytes(parts.pop(0))
+            if cmd == USE_NONCE:
+                # Nothing changes, so the workers don't reload
+                if self.use_nonce(parts[0], int(parts[1], 16)) is True:
+                    answer = b'OK'
+                else:
+                    answer = b'FAIL'
+                try:
+                    conn.send(answer)
+                except OSError:
+                    break
+                continue
+            port = parts.pop()
+            address = parts.pop()
+            parts.append((address.decode(), port.decode()))
+            try:
+                self.lookup[cmd](conn, parts)
+            except (KPError, ValueError, IndexError) as err:
+                logging.error(err.__str__())
+                try:
+                    conn.send(b'FAIL: '+err.__str__().encode())
+                except OSError:
+                    break
+            except OSError as err:
+                logging.error(err.__str__())
+                break
+            self.notify_workers()
+
+    def notify_workers(self):
+        """Tell the workers to reload the database"""
+
+        if self.db.password is None:
+            password = b''
+        else:
+            password = self.db.password.encode()
+        if self.db.keyfile is None:
+            keyfile = b''
+        else:
+            keyfile = self.db.keyfile.encode()
+        with self.events_lock:
+            for i in self.events:
+                try:
+                    i.send(password, keyfile)
+                except OSError as err:
+                    logging.error(err.__str__())
+
+    def serve_worker(self, request_sock, event_sock):
+        """Handle clients in a worker process, never returns"""
+
+        try:
+            self.children = None
+            self.events = []
+            self.writer_conn = Connection(request_sock, True)
+            # Inherited sockets are shared, they can't be bound again
+            if hasattr(socket, 'SO_REUSEPORT') and not self.inherited:
+                for i in ('sock', 'net_sock', 'tls_sock'):
+                    inherited = getattr(self, i)
+                    if inherited is not None:
+                        setattr(self, i, self.listen_tcp(
+                            *inherited.getsockname()[:2]))
+                        inherited.close()
+            # The socket file belongs to the writer
+            self.unix_socket = None
+            for i in self.lookup:
+                if i not in READ_COMMANDS:
+                    self.lookup[i] = functools.partial(self.forward, i)
+
+            event_thread = threading.Thread(target=self.listen_writer,
+                                            args=(event_sock,))
+            event_thread.daemon = True
+            event_thread.start()
+            if self.engine == 'asyncio':
+                self.serve_async()
+            else:
+                self.serve_threads()
+                while self.stopped.wait(1) is False:
+                    pass
+        except Exception as err:
+            logging.error(err.__str__())
+        finally:
+            os._exit(0)
+
+    def forward(self, cmd, conn, parts):
+        """Let the writer process execute a command"""
+
+        client = parts.pop()
+        self.check_deadline(conn, client)
+        with self.writer_lock:
+            self.writer_conn.send(cmd, *parts, client[0].encode(),
+                                  str(client[1]).encode())
+            answer = self.writer_conn.receive()
+        conn.send(answer)
+
+    def listen_writer(self, sock):
+        """Reload the database whenever the writer changed it"""
+
+        conn = Connection(sock, True)
+        while True:
+            try:
+                msg = conn.receive()
+                # Only the last of several changes has to be loaded
+                while select.select([sock], [], [], 0)[0]:
+                    msg = conn.receive()
+            except OSError:
+                logging.error('Lost the writer process')
+                self.handle_sigterm(None, None)
+                return
+            password, keyfile = msg.split(BREAK)
+            self.reload(password.decode() or None, keyfile.decode() or None)
+
+    def reload(self, password, keyfile):
+        """Replace the database by the saved one
+
+        The new database is loaded before it's swapped in, lookups keep
+        using the old snapshot until then.
+
+        """
+
+        for i in range(RELOAD_ATTEMPTS):
+            try:
+                with open(self.db_path, 'rb') as handler:
+                    buf = handler.read()
+                db = KPDBv1(None, password, keyfile, True)
+                # Unless the credentials were changed the key isn't
+                # transformed again
+                db._transform_key = self.cached_transform(db)
+                db.load(buf)
+                break
+            except (KPError, OSError, struct.error) as err:
+                # The writer may have replaced the file again, e.g. after
+                # changing the credentials which this notification
+                # doesn't know yet
+                if i == RELOAD_ATTEMPTS - 1:
+                    logging.error('Could not reload the database: '+
+                                  err.__str__())
+                    return
+                time.sleep(0.1)
+        if (db.password, db.keyfile) != (self.db.password, self.db.keyfile):
+            # The writer executed CHANGESECRET
+            self.cred_cache.flush()
+        with self.db_lock.writing():
+            self.db = db
+            self.snapshot = self.make_snapshot(db, buf,
+                                               self.snapshot.version + 1)
+
     def handle_non_tls(self, sock):
         while True:
             try:
                 conn, client = sock.accept()
+            except socket.timeout:
+                continue
             except OSError as err:
                 # For correct closing
                 if "Bad file descriptor" in err.__str__():
@@ -205,69 +886,754 @@ class Server(Daemon):
                 logging.error(err.__str__())
             else:
                 logging.info('Connection from '+client[0]+':'+str(client[1]))
-                client_thread = threading.Thread(target=self.handle_client,
-                                                 args=(conn,client,))
-                client_thread.daemon = True
-                client_thread.start()
+                self.dispatch(conn, client)
 
     def handle_tls(self):
         while True:
             try:
-                conn_tmp, client = self.tls_sock.accept()
-                conn = self.context.wrap_socket(conn_tmp, server_side = True)
-            except (ssl.SSLError, OSError) as err:
+                conn, client = self.tls_sock.accept()
+            except socket.timeout:
+                continue
+            except OSError as err:
                 # For correct closing
                 if "Bad file descriptor" in err.__str__():
                     break
                 logging.error(err.__str__())
             else:
                 logging.info('Connection from '+client[0]+':'+str(client[1]))
-                client_thread = threading.Thread(target=self.handle_client,
-                                                 args=(conn, client,))
-                client_thread.daemon = True
-                client_thread.start()
+                # The handshake is done by the worker
+                self.dispatch(conn, client, True)
+
+    def handle_unix(self):
+        """Accept local clients which run as the same user"""
+
+        while True:
+            try:
+                conn, client = self.unix_sock.accept()
+            except socket.timeout:
+                continue
+            except OSError as err:
+                # For correct closing; accept fails with EINVAL after
+                # the shutdown of a Unix domain socket
+                if err.errno in (EBADF, EINVAL):
+                    break
+                logging.error(err.__str__())
+                continue
+            try:
+                credentials = peer_credentials(conn)
+            except OSError as err:
+                logging.error(err.__str__())
+                conn.close()
+                continue
+            # Without SO_PEERCRED the permissions of the socket file
+            # have to do
+            if credentials is not None and credentials[1] != getuid():
+                logging.error('Refused connection from uid '+
+                              str(credentials[1]))
+                conn.close()
+                continue
+            if credentials is not None:
+                client = ('unix', credentials[0])
+            else:
+                client = ('unix', 0)
+            logging.info('Connection from local process '+str(client[1]))
+            self.dispatch(conn, client)
+
+    def count(self, counter, queued = 0):
+        """Count an accepted or rejected client"""
+
+        with self.pool_lock:
+            self.pool_stats[counter] += 1
+            if queued > self.pool_stats['max_queued']:
+                self.pool_stats['max_queued'] = queued
+
+    def dispatch(self, sock, client, tls = False):
+        """Queue an accepted client for the workers
+
+        The client is queued once it sent something, the watcher waits
+        for it. If the queue is full the client is rejected at once.
+
+        """
+
+        # A new client keeps the server from stopping when idle
+        self.last_active = time.monotonic()
+        if self.clients.qsize() >= self.queue_depth:
+            self.count('rejected')
+            logging.error('Too many clients, rejected '+client[0]+':'+
+                          str(client[1]))
+            self.reject_busy(sock, tls)
+        else:
+            with self.park_lock:
+                self.arriving.append((sock, client, tls))
+            self.wake_watcher()
+            self.count('accepted', self.clients.qsize())
+
+    def reject_busy(self, sock, tls):
+        """Tell a client that the server is busy and close the connection
+
+        The accept loop mustn't block, so this is done without waiting.
+        A TLS client would need a handshake first, it's just closed.
+
+        """
+
+        try:
+            sock.setblocking(False)
+            if tls is False:
+                sendmsg(sock, BUSY)
+                sock.shutdown(socket.SHUT_WR)
+                # Unread data would make close() reset the connection
+                # before the client got the answer
+                sock.recv(4096)
+        except OSError:
+            pass
+        sock.close()
+
+    def work(self):
+        """Handle the queued clients, sessions and pipelined requests
+
+        Every entry of the queue is a handler, the client it's for and
+        the arguments of the handler.
 
-    def handle_client(self, conn, client):
-        conn.settimeout(60)
+        """
 
+        while True:
+            handler, client, args = self.clients.get()
+            try:
+                handler(*args)
+            except Exception as err:
+                # E.g. a malformed request; the worker has to survive
+                logging.error('Handling '+client[0]+':'+str(client[1])+
+                              ' failed: '+repr(err))
+
+    def start_client(self, sock, client, tls, queued):
+        """Do the TLS handshake of a new client and handle it"""
+
+        if (self.request_timeout is not None and
+                time.monotonic() - queued > self.request_timeout):
+            # The client has given up already
+            self.count('expired')
+            logging.error('Dropped '+client[0]+':'+str(client[1])+
+                          ' after waiting too long')
+            sock.close()
+            return
+        if tls is True:
+            try:
+                sock.settimeout(60)
+                sock = self.context.wrap_socket(sock, server_side = True)
+            except (ssl.SSLError, OSError) as err:
+                logging.error(err.__str__())
+                sock.close()
+                return
+            if sock.session_reused is True:
+                logging.info('Resumed TLS session')
+        self.handle_client(sock, client)
+
+    def handle_client(self, sock, client, session = None):
+        """Handle the next request of a client
+
+        session is a parked Session which became readable, a new client
+        gets its Connection first. Sessions are parked again after their
+        request, so they don't keep the worker while they are idle.
+
+        """
+
+        sock.settimeout(60)
+        if session is None:
+            conn = Connection(sock, traffic = self.traffic,
+                              max_size = self.max_request,
+                              send_timeout = self.send_timeout,
+                              request_timeout = self.request_timeout)
+            try:
+                msg = conn.receive_first(*self.capabilities)
+                if conn.session is False:
+                    self.handle_request(conn, msg, client)
+                    conn.close()
+                    return
+            except MessageTooLarge as err:
+                self.reject(conn, err)
+                conn.close()
+                return
+            except OSError as err:
+                logging.error(err.__str__())
+                conn.close()
+                return
+            except:
+                conn.close()
+                raise
+            session = Session(conn, client)
+        else:
+            if session.failed is True:
+                self.end_session(session)
+                return
+            try:
+                msg = session.conn.receive()
+            except MessageTooLarge as err:
+                self.reject(session.conn, err)
+                self.end_session(session)
+                return
+            except OSError:
+                logging.info('Session of '+client[0]+':'+str(client[1])+
+                             ' ended')
+                self.end_session(session)
+                return
+
+        try:
+            if session.conn.pipelined is True:
+                self.handle_pipelined(session, msg)
+            elif self.handle_request(session.conn, msg, client) is True:
+                self.park(session)
+            else:
+                self.end_session(session)
+        except:
+            self.end_session(session)
+            raise
+
+    def reject(self, conn, err):
+        """Answer a request which is too large
+
+        The rest of the message isn't read, so the connection has to be
+        closed afterwards.
+
+        """
+
+        logging.error(err.__str__())
         try:
-            msg = receive(conn)
-            parts = msg.split(b'\xB2\xEA\xC0')
+            if conn.pipelined is True:
+                Reply(conn, conn.request_id).send(b'FAIL: Message too large')
+            else:
+                conn.send(b'FAIL: Message too large')
+        except OSError as err:
+            logging.error(err.__str__())
+
+    def handle_pipelined(self, session, msg):
+        """Start a request of a pipelined session
+
+        The request is queued for the workers like a client and answered
+        as soon as it's done, so answers may come in any order. Meanwhile
+        the session is parked for the next one. With max_pipeline requests
+        running the next one isn't received until one of them is done.
+
+        """
+
+        with session.lock:
+            session.running += 1
+            session.waiting = session.running >= self.max_pipeline
+            waiting = session.waiting
+        self.clients.put((self.run_pipelined, session.client,
+                          (session, Reply(session.conn,
+                                          session.conn.request_id), msg)))
+        if waiting is False:
+            self.park(session)
+
+    def run_pipelined(self, session, reply, msg):
+        """Handle a request of a pipelined session, see handle_pipelined"""
+
+        try:
+            succeeded = self.handle_request(reply, msg, session.client)
+        except Exception as err:
+            logging.error('Handling '+session.client[0]+':'+
+                          str(session.client[1])+' failed: '+repr(err))
+            succeeded = False
+        with session.lock:
+            session.running -= 1
+            if succeeded is False:
+                session.failed = True
+            resume = session.waiting
+            session.waiting = False
+            close = session.ended is True and session.running == 0
+        if close is True:
+            session.conn.close()
+        elif resume is True:
+            self.park(session)
+        elif succeeded is False:
+            # The watcher drops the session
+            self.wake_watcher()
+
+    def end_session(self, session):
+        """Stop receiving requests of a session
+
+        The connection is closed once no request of it is running.
+
+        """
+
+        with session.lock:
+            session.ended = True
+            close = session.running == 0
+        if close is True:
+            session.conn.close()
+
+    def park(self, session):
+        """Let the watcher wait for the next request of a session"""
+
+        conn = session.conn
+        if session.failed is True:
+            self.end_session(session)
+            return
+        if conn.buffered() is True:
+            # The request was decrypted already, the socket won't become
+            # readable for it
+            self.clients.put((self.handle_client, session.client,
+                              (conn.sock, session.client, session)))
+            return
+        with self.park_lock:
+            if self.draining is False:
+                self.parked.append(session)
+                session = None
+        if session is not None:
+            # The server is stopping
+            self.end_session(session)
+            return
+        self.wake_watcher()
+
+    def wake_watcher(self):
+        """Make the watcher look at the parked sessions"""
+
+        try:
+            self.wakeup[1].send(b'\x00')
+        except OSError:
+            # It's woken up already
+            pass
+
+    def watch_sessions(self):
+        """Queue parked sessions again when they send a request
+
+        Sessions which stay idle for idle_timeout seconds are ended, on
+        SIGTERM all of them are. New clients are queued when they start
+        sending, they get FIRST_REQUEST_TIMEOUT seconds for it.
+
+        """
+
+        idle = selectors.DefaultSelector()
+        idle.register(self.wakeup[0], selectors.EVENT_READ)
+        # Parked sessions and arriving clients by their deadline
+        deadlines = {}
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(min(deadlines.values()) - time.monotonic(), 0)
+            events = idle.select(timeout)
+            now = time.monotonic()
+            for key, mask in events:
+                if key.data is None:
+                    self.wakeup[0].recv(4096)
+                    continue
+                idle.unregister(key.fileobj)
+                del deadlines[key.data]
+                if isinstance(key.data, Session):
+                    self.clients.put((self.handle_client, key.data.client,
+                                      (key.fileobj, key.data.client,
+                                       key.data)))
+                else:
+                    sock, client, tls = key.data
+                    self.clients.put((self.start_client, client,
+                                      (sock, client, tls, now)))
+
+            with self.park_lock:
+                parked, self.parked = self.parked, []
+                arriving, self.arriving = self.arriving, []
+                draining = self.draining
+            for session in parked:
+                idle.register(session.conn.sock, selectors.EVENT_READ,
+                              session)
+                deadlines[session] = now + self.idle_timeout
+            for i in arriving:
+                idle.register(i[0], selectors.EVENT_READ, i)
+                deadlines[i] = now + FIRST_REQUEST_TIMEOUT
+            for waiting, deadline in list(deadlines.items()):
+                if isinstance(waiting, Session):
+                    if (draining is True or waiting.failed is True or
+                            deadline <= now):
+                        idle.unregister(waiting.conn.sock)
+                        del deadlines[waiting]
+                        logging.info('Session of '+waiting.client[0]+':'+
+                                     str(waiting.client[1])+' ended')
+                        self.end_session(waiting)
+                elif draining is True or deadline <= now:
+                    sock, client, tls = waiting
+                    idle.unregister(sock)
+                    del deadlines[waiting]
+                    logging.info('No request from '+client[0]+':'+
+                                  str(client[1]))
+                    sock.close()
+
+    def serve_async(self):
+        """Serve all sockets from one event loop until SIGTERM"""
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        executor = ThreadPoolExecutor(self.workers)
+        self.loop.set_default_executor(executor)
+        try:
+            self.loop.run_until_complete(self.main_async())
+        except (OSError, ValueError) as err:
+            logging.error(err.__str__())
+        finally:
+            executor.shutdown(wait = True)
+            self.loop.close()
+
+    async def main_async(self):
+        """Start a server for every socket and wait for SIGTERM"""
+
+        self.stopping = asyncio.Event()
+        # The StreamReader needs to see the end of a legacy message
+        if self.max_request is not None:
+            limit = self.max_request + len(DEAD_END)
+        else:
+            limit = 1 << 62
+        servers = []
+        # Inherited sockets may not include all of them
+        if self.sock is not None:
+            servers.append(await asyncio.start_server(
+                self.handle_client_async, sock = self.sock, limit = limit))
+        if self.tls_req is False and self.net_sock is not None:
+            servers.append(await asyncio.start_server(
+                self.handle_client_async, sock = self.net_sock,
+                limit = limit))
+        if self.context is not None and self.tls_sock is not None:
+            # Handshakes are done by the event loop, too
+            servers.append(await asyncio.start_server(
+                self.handle_client_async, sock = self.tls_sock,
+                ssl = self.context, ssl_handshake_timeout = 60,
+                limit = limit))
+        if self.unix_sock is not None:
+            servers.append(await asyncio.start_unix_server(
+                self.handle_client_async, sock = self.unix_sock,
+                limit = limit))
+        logging.info('Serving with asyncio')
+        self.log_ready()
+        await self.stopping.wait()
+        for i in servers:
+            i.close()
+        deadline = self.drain_start + self.drain_timeout
+        while self.in_flight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        dropped = self.in_flight
+        # Idle sessions and requests which took too long are dropped
+        clients = [i for i in asyncio.all_tasks()
+                   if i is not asyncio.current_task()]
+        for i in clients:
+            i.cancel()
+        await asyncio.gather(*clients, return_exceptions = True)
+        self.finish_drain(dropped)
+
+    async def handle_client_async(self, reader, writer):
+        """Handle a connection in the event loop
+
+        Requests are handled in the default executor like handle_request
+        does it for the threads engine.
+
+        """
+
+        self.last_active = time.monotonic()
+        conn = AsyncConnection(reader, writer, self.loop, self.traffic,
+                               self.max_request, self.send_timeout,
+                               self.request_timeout)
+        client = writer.get_extra_info('peername')
+        if not client:
+            try:
+                credentials = peer_credentials(conn.sock)
+            except OSError as err:
+                logging.error(err.__str__())
+                conn.close()
+                return
+            if credentials is not None and credentials[1] != getuid():
+                logging.error('Refused connection from uid '+
+                              str(credentials[1]))
+                conn.close()
+                return
+            if credentials is not None:
+                client = ('unix', credentials[0])
+            else:
+                client = ('unix', 0)
+        logging.info('Connection from '+client[0]+':'+str(client[1]))
+
+        # Pipelined requests which are handled at the moment
+        requests = set()
+        slots = asyncio.Semaphore(self.max_pipeline)
+        failed = asyncio.Event()
+
+        async def execute(target, msg):
+            # Like the queue of the threads engine at most queue_depth
+            # requests wait for a worker
+            if self.pending >= self.workers + self.queue_depth:
+                self.count('rejected')
+                logging.error('Too many requests, rejected '+client[0]+':'+
+                              str(client[1]))
+                await target.send_async(BUSY)
+                return False
+            self.pending += 1
+            self.count('accepted', self.pending - self.workers)
+            try:
+                return await self.loop.run_in_executor(
+                    None, self.handle_request, target, msg, client)
+            finally:
+                self.pending -= 1
+
+        async def work(reply, msg):
+            try:
+                if await execute(reply, msg) is False:
+                    failed.set()
+            finally:
+                slots.release()
+
+        try:
+            msg = await asyncio.wait_for(
+                conn.receive_first_async(*self.capabilities),
+                60)
+            while True:
+                if conn.pipelined is True:
+                    await slots.acquire()
+                    request = asyncio.ensure_future(
+                        work(Reply(conn, conn.request_id), msg))
+                    requests.add(request)
+                    request.add_done_callback(requests.discard)
+                elif (await execute(conn, msg) is False or
+                          conn.session is False):
+                    break
+                if failed.is_set():
+                    break
+                # Wait for the next request of the session
+                try:
+                    msg = await asyncio.wait_for(conn.receive_async(),
+                                                 self.idle_timeout)
+                except (OSError, asyncio.TimeoutError):
+                    logging.info('Session of '+client[0]+':'+
+                                 str(client[1])+' ended')
+                    break
+        except MessageTooLarge as err:
+            logging.error(err.__str__())
+            try:
+                await conn.send_async(b'FAIL: Message too large')
+            except OSError as err:
+                logging.error(err.__str__())
+        except (OSError, asyncio.TimeoutError) as err:
+            logging.error('Connection of '+client[0]+':'+str(client[1])+
+                          ' failed: '+repr(err))
+        finally:
+            if requests:
+                await asyncio.wait(requests)
+            conn.close()
+
+    def handle_request(self, conn, msg, client):
+        """Authenticate and execute one request
+
+        Returns False if the connection should be closed.
+
+        """
+
+        with self.requests_done:
+            if self.draining is True:
+                refused = True
+            else:
+                refused = False
+                self.in_flight += 1
+                self.last_active = time.monotonic()
+        if refused is True:
+            try:
+                conn.send(b'FAIL: Server is stopping')
+            except OSError as err:
+                logging.error(err.__str__())
+            return False
+
+        try:
+            return self.execute_request(conn, msg, client)
+        finally:
+            with self.requests_done:
+                self.in_flight -= 1
+                self.last_active = time.monotonic()
+                if self.in_flight == 0:
+                    self.requests_done.notify_all()
+
+    def execute_request(self, conn, msg, client):
+        """Authenticate and execute a request, see handle_request
+
+        Handlers can check conn.expired() to skip work nobody waits for
+        anymore.
+
+        """
+
+        try:
+            # E.g. the request waited too long for a worker
+            self.check_deadline(conn, client)
+            parts = msg.split(BREAK)
             parts.append(client)
             password = parts.pop(0)
             keyfile = parts.pop(0)
-            cmd = parts.pop(0)
-
-            if password == b'':
-                password = None
+            # The parts of a big message are bytearrays, which can't be
+            # looked up
+            cmd = bytes(parts.pop(0))
+
+            # The last part is the client address
+            if (cmd in self.limits and
+                    sum(len(i) for i in parts[:-1]) > self.limits[cmd]):
+                conn.send(b'FAIL: Message too large')
+                raise MessageTooLarge('Arguments of '+cmd.decode()+
+                                      ' are too large')
+
+            if password == TOKEN:
+                # The keyfile part holds the token
+                if self.check_token(keyfile, client[0]) is False:
+                    # Mostly the token just expired, the session stays
+                    # open for the next LOGIN
+                    logging.info('Received invalid token from '+client[0])
+                    conn.send(INVALID_TOKEN)
+                    return True
+            elif password == RESPONSE and keyfile == b'':
+                self.send_challenge(conn, client[0])
+                return True
+            elif password == RESPONSE:
+                self.check_response(conn, keyfile, client)
             else:
-                password = password.decode()
-            if keyfile == b'':
-                keyfile = None
-            if self.check_password(password, keyfile) is False:
-                sendmsg(conn, b'FAIL: Wrong password')
-                raise OSError("Received wrong password")
+                self.authenticate(conn, password, keyfile, client)
+            self.check_deadline(conn, client)
         except OSError as err:
             logging.error(err.__str__())
+            return False
         else:
             try:
                 if cmd in self.lookup:
                     self.lookup[cmd](conn, parts)
                 else:
                     logging.error('Received a wrong command')
-                    sendmsg(conn, b'FAIL: Command isn\'t available')
+                    conn.send(b'FAIL: Command isn\'t available')
             except (OSError, ValueError) as err:
                 logging.error(err.__str__())
+                return False
+        return True
+
+    def authenticate(self, conn, password, keyfile, client):
+        """Check the credentials of a request, raise OSError if they fail"""
+
+        own_key = self.own_key(self.db)
+        if self.cred_cache.lookup(password, keyfile, client[0], own_key):
+            return
+        credentials = (password, keyfile, client[0], own_key)
+        if password == b'':
+            password = None
+        else:
+            password = password.decode()
+        if keyfile == b'':
+            keyfile = None
+        refused = self.admission.admit(client[0])
+        if refused is not None:
+            conn.send(b'FAIL: '+refused.encode())
+            raise OSError('Refused authentication of '+client[0]+
+                          ': '+refused)
+        try:
+            authenticated = self.check_password(password, keyfile)
         finally:
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
+            self.admission.release(client[0])
+        if authenticated is False:
+            conn.send(b'FAIL: Wrong password')
+            raise OSError("Received wrong password")
+        self.cred_cache.add(*credentials)
+
+    def send_challenge(self, conn, peer):
+        """Send the parameters of the key transformation and a nonce
+
+        The nonce is the expiry time, random bytes and the seed which
+        changes with every save, all in hex, and their signature, which
+        is bound to peer. So any process of the server can check it later
+        and the seed the client used is known.
+
+        """
+
+        db = self.db
+        seed = db._final_randomseed.hex().encode()
+        nonce = (format(int(time.time()) + CHALLENGE_LIFETIME, 'x').encode()+
+                 b'.'+os.urandom(16).hex().encode()+b'.'+seed)
+        signature = hmac.new(self.token_secret, nonce+b'.'+peer.encode(),
+                             'sha256').hexdigest().encode()
+        conn.send(db._transf_randomseed.hex().encode(),
+                  str(db._key_transf_rounds).encode(), seed,
+                  nonce+b'.'+signature)
+
+    def check_response(self, conn, response, client):
+        """Check the response to a challenge, raise OSError if it fails
+
+        The client proves that it knows the final key by the HMAC of the
+        nonce, the credentials themselves aren't sent.
+
+        """
+
+        refused = self.admission.admit(client[0])
+        if refused is not None:
+            conn.send(b'FAIL: '+refused.encode())
+            raise OSError('Refused authentication of '+client[0]+
+                          ': '+refused)
+        start = time.perf_counter()
+        try:
+            authenticated = self.verify_response(response, client[0])
+        finally:
+            self.admission.release(client[0])
+        self.count_auth(time.perf_counter() - start, authenticated)
+        if authenticated is False:
+            conn.send(b'FAIL: Wrong password')
+            raise OSError("Received wrong challenge response")
+
+    def verify_response(self, response, peer):
+        """Check a nonce and the response of peer to it"""
+
+        try:
+            nonce, mac = response.split(b':')
+            expiry, salt, seed, signature = nonce.split(b'.')
+            final_seed = bytes.fromhex(seed.decode())
+            valid = int(expiry, 16) > time.time()
+        except ValueError:
+            return False
+        body = nonce[:-len(signature) - 1]
+        if valid is False or not hmac.compare_digest(
+                hmac.new(self.token_secret, body+b'.'+peer.encode(),
+                         'sha256').hexdigest().encode(), signature):
+            return False
+        final = get_final_key(self.own_key(self.db), final_seed)
+        if not hmac.compare_digest(
+                hmac.new(final, nonce, 'sha256').hexdigest().encode(), mac):
+            return False
+        if self.writer_conn is not None:
+            # The response may have been sent to another worker process
+            with self.writer_lock:
+                self.writer_conn.send(USE_NONCE, nonce, expiry)
+                return self.writer_conn.receive() == b'OK'
+        return self.use_nonce(nonce, int(expiry, 16))
+
+    def use_nonce(self, nonce, expiry):
+        """Mark a nonce as used, False if it was used before"""
+
+        now = time.time()
+        with self.pool_lock:
+            if nonce in self.used_nonces:
+                # A replayed response
+                return False
+            for i in [i for i, j in self.used_nonces.items() if j <= now]:
+                del self.used_nonces[i]
+            self.used_nonces[nonce] = expiry
+        return True
+
+    def check_deadline(self, conn, client):
+        """Raise socket.timeout if the deadline of a request passed"""
+
+        if conn.expired():
+            self.count('expired')
+            raise socket.timeout('Deadline of a request of '+client[0]+':'+
+                                 str(client[1])+' passed')
+
+    def login(self, conn, parts):
+        """Send a token which the client may use instead of credentials
+
+        The token is bound to the address of the client, all clients of
+        the Unix domain socket share one.
+
+        """
+
+        conn.send(self.new_token(parts[-1][0]))
 
     def find(self, conn, parts):
         """Find entries and send them to connection"""
 
         title = parts.pop(0)
         msg = ''
-        for i in self.db.entries:
+        for i in self.snapshot.entries:
             if title.decode().lower() in i.title.lower():
                 msg += 'Title: '+i.title+'\n'
                 if i.url is not None:
@@ -287,14 +1653,43 @@ class Server(Daemon):
                 if i.comment is not None:
                     msg += 'Comment: '+i.comment+'\n'
                 msg += '\n'
-        sendmsg(conn, msg.encode())
+        conn.send(msg.encode())
+
+    def find_fields(self, conn, parts):
+        """Find entries and send only the requested fields as records
+
+        parts holds the title and the names of the fields. Without field
+        names all fields are sent.
+
+        """
+
+        title = parts.pop(0).decode().lower()
+        fields = parts[:-1]
+        if not fields:
+            fields = list(ENTRY_FIELDS)
+        for i in fields:
+            if i not in ENTRY_FIELDS:
+                conn.send(b'FAIL: Unknown field '+i)
+                return
+        names = [i.decode() for i in fields]
+
+        records = []
+        for i in self.snapshot.entries:
+            if title in i.title.lower():
+                record = []
+                for name in names:
+                    value = getattr(i, name)
+                    if value is None:
+                        record.append(None)
+                    else:
+                        record.append(value.__str__().encode())
+                records.append(record)
+        conn.send(pack_records(records, len(names)))
 
     def send_db(self, conn, parts):
-        with open(self.db_path, 'rb') as handler:
-            buf = handler.read()
-        sendmsg(conn, buf)
+        conn.send(self.snapshot.data)
 
-    @waitDecorator
+    @writer
     def create_group(self, conn, parts):
         title = parts.pop(0).decode()
         root = int(parts.pop(0))
@@ -306,17 +1701,15 @@ class Server(Daemon):
                     self.db.create_group(title, i)
                     break
                 elif i is self.db.groups[-1]:
-                    sendmsg(conn, b"FAIL: Parent doesn't exist anymore. "
-                                       b"You should refresh")
-                    return
-        self.db.save()
-        self.send_db(conn, [])
+                    return (b"FAIL: Parent doesn't exist anymore. "
+                            b"You should refresh")
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def change_password(self, conn, parts):
         client_add = parts[-1][0]
-        if client_add != "localhost" and client_add != "127.0.0.1":
-            sendmsg(conn, b'Password change from remote is not allowed')
+        if client_add not in ("localhost", "127.0.0.1", "unix"):
+            return b'Password change from remote is not allowed'
 
         new_password = parts.pop(0).decode()
         new_keyfile = parts.pop(0).decode()
@@ -330,10 +1723,12 @@ class Server(Daemon):
         else:
             self.db.keyfile = realpath(expanduser(new_keyfile))
 
-        self.db.save()
-        sendmsg(conn, b"Password changed")
+        self.commit()
+        self.own_key(self.db)
+        self.cred_cache.flush()
+        return b"Password changed"
 
-    @waitDecorator
+    @writer
     def create_entry(self, conn, parts):
         title = parts.pop(0).decode()
         url = parts.pop(0).decode()
@@ -351,14 +1746,12 @@ class Server(Daemon):
                                      comment, y, mon, d)
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group for entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Group for entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def delete_group(self, conn, parts):
         group_id = int(parts.pop(0))
         time = datetime(int(parts[0]), int(parts[1]), int(parts[2]),
@@ -368,21 +1761,18 @@ class Server(Daemon):
         for i in self.db.groups:
             if i.id_ == group_id:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Group was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to delete this group try it again.")
-                    return
+                    return (b"FAIL: Group was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to delete this group try it again.")
                 i.remove_group()
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Group doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def delete_entry(self, conn, parts):
         uuid = parts.pop(0)
         time = datetime(int(parts[0]), int(parts[1]), int(parts[2]),
@@ -392,21 +1782,18 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to delete this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to delete this entry try it again.")
                 i.remove_entry()
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def move_group(self, conn, parts):
         group_id = int(parts.pop(0))
         root = int(parts.pop(0))
@@ -421,20 +1808,17 @@ class Server(Daemon):
                             i.move_group(j)
                             break
                         elif j is self.db.groups[-1]:
-                            sendmsg(conn, b"FAIL: New parent doesn't "
-                                               b"exist anymore. You should "
-                                               b"refresh")
-                            return
+                            return (b"FAIL: New parent doesn't "
+                                    b"exist anymore. You should "
+                                    b"refresh")
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Group doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def move_entry(self, conn, parts):
         uuid = parts.pop(0)
         root = int(parts.pop(0))
@@ -446,19 +1830,16 @@ class Server(Daemon):
                         i.move_entry(j)
                         break
                     elif j is self.db.groups[-1]:
-                        sendmsg(conn, b"FAIL: New parent doesn't exist "
-                                           b"anymore. You should refresh")
-                        return
+                        return (b"FAIL: New parent doesn't exist "
+                                b"anymore. You should refresh")
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_g_title(self, conn, parts):
         title = parts.pop(0).decode()
         group_id = int(parts.pop(0))
@@ -469,21 +1850,18 @@ class Server(Daemon):
         for i in self.db.groups:
             if i.id_ == group_id:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Group was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this group try it again.")
-                    return
+                    return (b"FAIL: Group was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this group try it again.")
                 i.set_title(title)
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Group doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_e_title(self, conn, parts):
         title = parts.pop(0).decode()
         uuid = parts.pop(0)
@@ -494,21 +1872,18 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this entry try it again.")
                 i.set_title(title)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_e_user(self, conn, parts):
         username = parts.pop(0).decode()
         uuid = parts.pop(0)
@@ -519,21 +1894,18 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this entry try it again.")
                 i.set_username(username)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_e_url(self, conn, parts):
         url = parts.pop(0).decode()
         uuid = parts.pop(0)
@@ -544,21 +1916,18 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this entry try it again.")
                 i.set_url(url)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_e_comment(self, conn, parts):
         comment = parts.pop(0).decode()
         uuid = parts.pop(0)
@@ -569,21 +1938,18 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this entry try it again.")
                 i.set_comment(comment)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_e_pass(self, conn, parts):
         password = parts.pop(0).decode()
         uuid = parts.pop(0)
@@ -594,21 +1960,18 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this entry try it again.")
                 i.set_password(password)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
-    @waitDecorator
+    @writer
     def set_e_exp(self, conn, parts):
         y = int(parts.pop(0))
         mon = int(parts.pop(0))
@@ -621,31 +1984,136 @@ class Server(Daemon):
         for i in self.db.entries:
             if i.uuid == uuid:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
-                    return
+                    return (b"FAIL: Entry was modified. You should "
+                            b"refresh and if you're sure you want "
+                            b"to edit this entry try it again.")
                 i.set_expire(y, mon, d)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
-                return
+                return (b"FAIL: Entry doesn't exist "
+                        b"anymore. You should refresh")
 
-        self.db.save()
-        self.send_db(conn, [])
+        return self.commit()
 
     def check_last_mod(self, obj, time):
        return obj.last_mod.timetuple() > time
 
     def handle_sigterm(self, signum, frame):
-        self.db.lock()
-        if self.sock is not None:
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
-        if self.net_sock is not None:
-            self.net_sock.shutdown(socket.SHUT_RDWR)
-            self.net_sock.close()
-        if self.tls_sock is not None:
-            self.tls_sock.shutdown(socket.SHUT_RDWR)
-            self.tls_sock.close()
+        """Stop accepting clients and drain the running requests
+
+        Requests which are running get drain_timeout seconds to finish,
+        later ones are refused. The asyncio engine and the writer of the
+        prefork mode drain in their main loop, so this only tells them to.
+
+        """
+
+        with self.requests_done:
+            if self.draining is True:
+                # Daemon.stop() sends SIGTERM until the server is gone
+                return
+            self.draining = True
+            self.drain_start = time.monotonic()
+        logging.info('Draining '+str(self.in_flight)+' requests')
+
+        if self.children is not None:
+            # The writer of the prefork mode stops its workers
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            return
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            return
+
+        if self.wakeup is not None:
+            # The parked sessions are closed
+            self.wake_watcher()
+
+        for i in (self.sock, self.net_sock, self.tls_sock, self.unix_sock):
+            if i is not None:
+                # An inherited socket is closed only, the accept loops
+                # notice it within a second
+                if i not in self.inherited:
+                    try:
+                        i.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                i.close()
+        deadline = self.drain_start + self.drain_timeout
+        with self.requests_done:
+            while self.in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.requests_done.wait(remaining)
+            dropped = self.in_flight
+        self.finish_drain(dropped)
+
+    def handle_sighup(self, signum, frame):
+        """Forget the cached credentials
+
+        The writer of the prefork mode passes the signal to its workers.
+
+        """
+
+        self.cred_cache.flush()
+        logging.info('Flushed the credential cache')
+        if self.children is not None:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGHUP)
+                except OSError:
+                    pass
+
+    def finish_drain(self, dropped):
+        """Lock the database after draining and report it"""
+
+        # A change which is still being saved is finished first
+        with self.db_lock.writing():
+            self.db.lock()
+        if self.unix_socket is not None:
+            try:
+                remove(self.unix_socket)
+            except OSError:
+                pass
+        logging.info('Drained in {0:.3f} seconds, {1} requests dropped'
+                     .format(time.monotonic() - self.drain_start, dropped))
+        self.log_stats()
+        self.stopped.set()
+
+    def handle_sigusr1(self, signum, frame):
+        """Log the statistics of the running server
+
+        The writer of the prefork mode passes the signal to its workers,
+        every process logs its own statistics.
+
+        """
+
+        # The interrupted thread may hold a lock which the statistics
+        # need, so they are logged by another one
+        stats_thread = threading.Thread(target=self.log_stats)
+        stats_thread.daemon = True
+        stats_thread.start()
+        if self.children is not None:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGUSR1)
+                except OSError:
+                    pass
+
+    def log_stats(self):
+        """Log the counters of the clients, logins and database lock"""
+
+        with self.pool_lock:
+            pool_stats = dict(self.pool_stats)
+            auth_stats = dict(self.auth_stats)
+        logging.info('Statistics of process '+str(os.getpid()))
+        # Lookups read the snapshot, only writers wait for the lock
+        logging.info('Database lock waits: '+
+                     str(self.db_lock.get_stats()['write']))
+        logging.info('Clients: '+str(pool_stats))
+        logging.info('Authentications: '+str(self.admission.get_stats()))
+        logging.info('Key checks: '+str(auth_stats))
+        logging.info('Credential cache: '+str(self.cred_cache.get_stats()))
@@ -0,0 +1,70 @@
+"""Tests for keepassc.admission"""
+
+import unittest
+from unittest import mock
+
+from keepassc.admission import Admission
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('keepassc.admission.time.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrency(self):
+        admission = Admission(2, 0, 0)
+        self.assertIsNone(admission.admit('a'))
+        self.assertIsNone(admission.admit('a'))
+        self.assertIsNotNone(admission.admit('a'))
+        # Other peers have limits of their own
+        self.assertIsNone(admission.admit('b'))
+        admission.release('a')
+        self.assertIsNone(admission.admit('a'))
+        self.assertEqual(admission.get_stats(),
+                         {'admitted': 4, 'rate_limited': 0,
+                          'concurrency_limited': 1})
+
+    def test_release_forgets_peer(self):
+        admission = Admission(1, 0, 0)
+        admission.admit('a')
+        admission.release('a')
+        self.assertEqual(admission.running, {})
+
+    def test_rate(self):
+        admission = Admission(0, 2, 3)
+        for i in range(3):
+            self.assertIsNone(admission.admit('a'))
+        self.assertIsNotNone(admission.admit('a'))
+        self.now += 0.5
+        self.assertIsNone(admission.admit('a'))
+        self.assertIsNotNone(admission.admit('a'))
+        # The bucket refills to burst at most
+        self.now += 60
+        for i in range(3):
+            self.assertIsNone(admission.admit('a'))
+        self.assertIsNotNone(admission.admit('a'))
+        self.assertEqual(admission.get_stats()['rate_limited'], 3)
+
+    def test_no_limits(self):
+        admission = Admission(0, 0, 0)
+        for i in range(100):
+            self.assertIsNone(admission.admit('a'))
+        self.assertEqual(admission.buckets, {})
+
+    def test_prune(self):
+        admission = Admission(0, 1, 1)
+        admission.MAX_IDLE_BUCKETS = 2
+        admission.admit('a')
+        admission.admit('b')
+        self.now += 1
+        admission.admit('c')
+        # a and b are full again and dropped, only c is left
+        self.assertEqual(list(admission.buckets), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
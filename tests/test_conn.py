@@ -0,0 +1,243 @@
+"""Tests for the wire protocol in keepassc.conn"""
+
+import asyncio
+import mmap
+import socket
+import threading
+import time
+import unittest
+
+from keepassc.conn import *
+
+
+def socket_pair():
+    """Get two connected TCP sockets on the loopback interface"""
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    left = socket.create_connection(listener.getsockname())
+    right, address = listener.accept()
+    listener.close()
+    return (left, right)
+
+
+class RecordsTest(unittest.TestCase):
+    """pack_records and unpack_records"""
+
+    def test_round_trip(self):
+        records = [(b'title', b'', None), (BREAK + DEAD_END, b'\x00' * 300,
+                                           b'url')]
+        self.assertEqual(unpack_records(pack_records(records, 3)), records)
+
+    def test_no_records(self):
+        self.assertEqual(unpack_records(pack_records([], 7)), [])
+
+    def test_truncated(self):
+        buf = pack_records([(b'title', b'user')], 2)
+        with self.assertRaises(ValueError):
+            unpack_records(buf[:-1])
+        with self.assertRaises(ValueError):
+            unpack_records(buf[:3])
+
+
+class ConnectionTest(unittest.TestCase):
+    """Messages between two Connections over a loopback connection"""
+
+    def setUp(self):
+        self.left, self.right = socket_pair()
+        self.left.settimeout(5)
+        self.right.settimeout(5)
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def pair(self, *capabilities, max_size = None, spool_limit = None):
+        """Get two framed Connections which agreed on capabilities"""
+
+        sender = Connection(self.left, True)
+        receiver = Connection(self.right, True, max_size = max_size,
+                              spool_limit = spool_limit)
+        for i in (sender, receiver):
+            i.set_capabilities([FRAMED] + list(capabilities))
+        return (sender, receiver)
+
+    def send_later(self, conn, *parts, **kwargs):
+        """Send from a thread, big messages don't fit into the socket"""
+
+        sender = threading.Thread(target=conn.send, args=parts,
+                                  kwargs=kwargs)
+        sender.start()
+        self.addCleanup(sender.join)
+
+    def test_framed_round_trip(self):
+        sender, receiver = self.pair()
+        # Framed messages may contain the separators of the legacy mode
+        parts = (b'FIND', b'a' + DEAD_END + b'b', b'')
+        sender.send(*parts)
+        sender.send(b'next')
+        self.assertEqual(receiver.receive(), build_message(parts))
+        self.assertEqual(receiver.receive(), b'next')
+
+    def test_compressed_round_trip(self):
+        for i in COMPRESSIONS:
+            with self.subTest(compression = i):
+                sender, receiver = self.pair(i)
+                msg = b'entry ' * 1000
+                sender.send(msg)
+                self.assertEqual(receiver.receive(), msg)
+                self.assertLess(receiver.traffic['received'], len(msg))
+
+    def test_request_ids(self):
+        sender, receiver = self.pair(SESSION, RID)
+        self.assertTrue(receiver.pipelined)
+        sender.send(b'first', request_id = 7)
+        sender.send(b'second', request_id = 3)
+        self.assertEqual(receiver.receive(), b'first')
+        self.assertEqual(receiver.request_id, 7)
+        self.assertEqual(receiver.receive(), b'second')
+        self.assertEqual(receiver.request_id, 3)
+
+    def test_big_message(self):
+        sender, receiver = self.pair()
+        msg = b'x' * (REUSE_LIMIT + 1)
+        self.send_later(sender, msg)
+        answer = receiver.receive()
+        # It isn't copied out of the receive buffer
+        self.assertIs(type(answer), bytearray)
+        self.assertEqual(answer, msg)
+
+    def test_spooled(self):
+        msg = b'entry ' * 20000
+        for i in (None,) + COMPRESSIONS:
+            with self.subTest(compression = i):
+                if i is None:
+                    sender, receiver = self.pair(spool_limit = 100)
+                else:
+                    sender, receiver = self.pair(i, spool_limit = 100)
+                self.send_later(sender, msg)
+                answer = receiver.receive()
+                self.assertIs(type(answer), mmap.mmap)
+                self.assertEqual(answer[:], msg)
+
+    def test_spooled_too_large(self):
+        sender, receiver = self.pair(ZLIB, max_size = 1000,
+                                     spool_limit = 10)
+        sender.send(b'x' * 100000)
+        with self.assertRaises(MessageTooLarge):
+            receiver.receive()
+
+    def test_spooled_async(self):
+        sender = Connection(self.left, True)
+        msg = b'x' * 1000
+        sender.send(msg)
+
+        async def receive():
+            reader, writer = await asyncio.open_connection(sock = self.right)
+            receiver = AsyncConnection(reader, writer,
+                                       asyncio.get_running_loop(),
+                                       spool_limit = 100)
+            receiver.set_capabilities([FRAMED])
+            return await receiver.receive_async()
+
+        self.assertEqual(asyncio.run(receive())[:], msg)
+
+    def test_send_without_loop(self):
+        # The event loop stopped, e.g. after draining, while a handler in
+        # the executor still answers
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        reader, writer = loop.run_until_complete(
+            asyncio.open_connection(sock = self.right))
+        conn = AsyncConnection(reader, writer, loop)
+        errors = []
+
+        def send():
+            try:
+                conn.send(b'answer')
+            except OSError as err:
+                errors.append(err)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        while not conn.sends:
+            time.sleep(0.01)
+        conn.close()
+        sender.join(5)
+        self.assertEqual(len(errors), 1)
+        # Let the cancelled write end
+        loop.run_until_complete(asyncio.sleep(0))
+        with self.assertRaises(OSError):
+            conn.send(b'late answer')
+
+    def test_reused_buffer(self):
+        sender, receiver = self.pair()
+        sender.send(b'a' * 100)
+        first = receiver.receive()
+        sender.send(b'b' * 50)
+        receiver.receive()
+        self.assertEqual(first, b'a' * 100)
+
+    def test_too_large(self):
+        sender, receiver = self.pair(max_size = 10)
+        sender.send(b'x' * 11)
+        with self.assertRaises(MessageTooLarge):
+            receiver.receive()
+
+    def test_negotiation(self):
+        client = Connection(self.left)
+        server = Connection(self.right)
+        accepted = []
+
+        def negotiate():
+            accepted.append(client.negotiate(FRAMED, SESSION, b'ZLIB=3',
+                                             b'UNKNOWN'))
+            client.send(b'request')
+
+        client_thread = threading.Thread(target=negotiate)
+        client_thread.start()
+        msg = server.receive_first(FRAMED, SESSION, ZLIB)
+        client_thread.join()
+        self.assertEqual(msg, b'request')
+        self.assertEqual(accepted, [[FRAMED, SESSION, b'ZLIB=3']])
+        for i in (client, server):
+            self.assertTrue(i.framed)
+            self.assertTrue(i.session)
+            self.assertFalse(i.pipelined)
+            self.assertEqual((i.compression, i.level), (ZLIB, 3))
+
+    def test_broken_compression_level(self):
+        client = Connection(self.left)
+        sendmsg(self.right, HELLO+b' FRAMED ZLIB=fast')
+        self.assertEqual(client.negotiate(FRAMED, ZLIB),
+                         [FRAMED, b'ZLIB=fast'])
+        self.assertTrue(client.framed)
+        self.assertIsNone(client.compression)
+
+    def test_legacy_client(self):
+        server = Connection(self.right)
+        sendmsg(self.left, build_message((b'secret', b'', b'GET')))
+        msg = server.receive_first(FRAMED, SESSION)
+        self.assertEqual(msg.split(BREAK), [b'secret', b'', b'GET'])
+        self.assertFalse(server.framed)
+        server.send(b'answer')
+        self.assertEqual(receive(self.left), b'answer')
+
+    def test_legacy_server(self):
+        client = Connection(self.left)
+        # An old server takes the hello for a request with a wrong
+        # password
+        sendmsg(self.right, b'FAIL: Wrong password')
+        self.assertIsNone(client.negotiate(FRAMED))
+        self.assertFalse(client.framed)
+
+    def test_busy_server(self):
+        client = Connection(self.left)
+        sendmsg(self.right, BUSY)
+        with self.assertRaises(ServerBusy):
+            client.negotiate(FRAMED)
+
+
+if __name__ == '__main__':
+    unittest.main()
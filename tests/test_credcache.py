@@ -0,0 +1,78 @@
+"""Tests for keepassc.credcache"""
+
+import unittest
+from unittest import mock
+
+from keepassc.credcache import CredentialCache
+
+KEY = b'\x01' * 32
+
+
+class CredentialCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('keepassc.credcache.time.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup(self):
+        cache = CredentialCache(60, 10)
+        self.assertFalse(cache.lookup(b'secret', b'', '127.0.0.1', KEY))
+        cache.add(b'secret', b'', '127.0.0.1', KEY)
+        self.assertTrue(cache.lookup(b'secret', b'', '127.0.0.1', KEY))
+        # Every part of the credentials counts
+        self.assertFalse(cache.lookup(b'other', b'', '127.0.0.1', KEY))
+        self.assertFalse(cache.lookup(b'secret', b'key', '127.0.0.1', KEY))
+        self.assertFalse(cache.lookup(b'secret', b'', '10.0.0.1', KEY))
+        self.assertFalse(cache.lookup(b'secret', b'', '127.0.0.1',
+                                      b'\x02' * 32))
+        self.assertEqual(cache.get_stats()['hits'], 1)
+
+    def test_expiry(self):
+        cache = CredentialCache(60, 10)
+        cache.add(b'secret', b'', 'unix', KEY)
+        self.now += 59
+        self.assertTrue(cache.lookup(b'secret', b'', 'unix', KEY))
+        self.now += 1
+        self.assertFalse(cache.lookup(b'secret', b'', 'unix', KEY))
+        stats = cache.get_stats()
+        self.assertEqual((stats['expired'], stats['entries']), (1, 0))
+
+    def test_eviction(self):
+        cache = CredentialCache(60, 2)
+        cache.add(b'a', b'', 'unix', KEY)
+        cache.add(b'b', b'', 'unix', KEY)
+        # a was used last, so b is dropped for c
+        cache.lookup(b'a', b'', 'unix', KEY)
+        cache.add(b'c', b'', 'unix', KEY)
+        self.assertTrue(cache.lookup(b'a', b'', 'unix', KEY))
+        self.assertFalse(cache.lookup(b'b', b'', 'unix', KEY))
+        self.assertTrue(cache.lookup(b'c', b'', 'unix', KEY))
+        self.assertEqual(cache.get_stats()['evicted'], 1)
+
+    def test_flush(self):
+        cache = CredentialCache(60, 10)
+        cache.add(b'a', b'', 'unix', KEY)
+        cache.add(b'b', b'', 'unix', KEY)
+        cache.flush()
+        self.assertFalse(cache.lookup(b'a', b'', 'unix', KEY))
+        self.assertEqual(cache.get_stats()['flushed'], 2)
+
+    def test_disabled(self):
+        for ttl, size in ((0, 10), (60, 0)):
+            cache = CredentialCache(ttl, size)
+            cache.add(b'secret', b'', 'unix', KEY)
+            self.assertFalse(cache.lookup(b'secret', b'', 'unix', KEY))
+            self.assertEqual(cache.get_stats()['entries'], 0)
+
+    def test_no_plain_credentials(self):
+        cache = CredentialCache(60, 10)
+        cache.add(b'secret', b'keyfile', 'unix', KEY)
+        for i in cache.entries:
+            self.assertNotIn(b'secret', i)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Tests for keepassc.rwlock"""
+
+import threading
+import time
+import unittest
+
+from keepassc.rwlock import RWLock
+
+
+class RWLockTest(unittest.TestCase):
+
+    def start(self, target):
+        thread = threading.Thread(target=target)
+        thread.start()
+        self.addCleanup(thread.join)
+        # Give it the time to queue up
+        time.sleep(0.05)
+        return thread
+
+    def test_readers_share(self):
+        lock = RWLock()
+        with lock.reading():
+            with lock.reading():
+                self.assertEqual(lock.readers, 2)
+        self.assertEqual(lock.readers, 0)
+
+    def test_fifo(self):
+        lock = RWLock()
+        order = []
+
+        def write(name):
+            with lock.writing():
+                order.append(name)
+
+        def read(name):
+            with lock.reading():
+                order.append(name)
+
+        lock.acquire_write()
+        threads = [self.start(lambda: write('first writer')),
+                   self.start(lambda: read('reader')),
+                   self.start(lambda: write('second writer'))]
+        lock.release_write()
+        for i in threads:
+            i.join(5)
+        self.assertEqual(order, ['first writer', 'reader', 'second writer'])
+
+    def test_reader_waits_for_queued_writer(self):
+        lock = RWLock()
+        lock.acquire_read()
+        writer = self.start(lock.acquire_write)
+        acquired = threading.Event()
+
+        def read():
+            with lock.reading():
+                acquired.set()
+
+        self.start(read)
+        # A reader coming after the waiting writer doesn't overtake it
+        self.assertFalse(acquired.is_set())
+        lock.release_read()
+        writer.join(5)
+        self.assertTrue(lock.writer)
+        lock.release_write()
+        self.assertTrue(acquired.wait(5))
+
+    def test_stats(self):
+        lock = RWLock()
+        lock.acquire_write()
+        self.start(lock.acquire_write)
+        time.sleep(0.1)
+        lock.release_write()
+        time.sleep(0.05)
+        # The second writer holds the lock now
+        stats = lock.get_stats()
+        self.assertEqual(stats['write']['acquired'], 2)
+        self.assertEqual(stats['write']['waited'], 1)
+        self.assertGreaterEqual(stats['write']['max_wait'], 0.1)
+        self.assertEqual(stats['read']['acquired'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Tests for keepassc.server"""
+
+import binascii
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from kppy.database import KPDBv1
+
+from keepassc import server
+from keepassc.server import Server
+
+
+class CachedTransformTest(unittest.TestCase):
+    """Loading and saving with the cached key transformation"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'test.kdb')
+        # Only the key cache is needed, the daemon isn't started
+        self.server = Server.__new__(Server)
+        self.server.stretched_keys = {}
+
+    def make_db(self, keyfile):
+        db = KPDBv1(new=True)
+        db._key_transf_rounds = 1000
+        db.create_group('Group')
+        db.save(self.path, 'secret', keyfile)
+        db.close()
+
+    def load(self, keyfile):
+        db = KPDBv1(self.path, 'secret', keyfile, True)
+        db._transform_key = self.server.cached_transform(db)
+        db.load()
+        return db
+
+    def write_keyfile(self, content):
+        keyfile = os.path.join(self.dir.name, 'keyfile')
+        with open(keyfile, 'wb') as handler:
+            handler.write(content)
+        return keyfile
+
+    def test_keyfiles(self):
+        raw = os.urandom(32)
+        # kppy uses these keyfiles as they are instead of hashing them
+        for content in (raw, binascii.hexlify(raw), b'any keyfile'):
+            with self.subTest(size = len(content)):
+                keyfile = self.write_keyfile(content)
+                self.make_db(keyfile)
+                db = self.load(keyfile)
+                self.assertIn('Group', [i.title for i in db.groups])
+
+    def test_save(self):
+        self.make_db(None)
+        db = KPDBv1(self.path, 'secret', None)
+        db._transform_key = self.server.cached_transform(db)
+        db.load()
+        db.create_group('Other')
+        db.save()
+        db.close()
+        db = KPDBv1(self.path, 'secret', None, True)
+        db.load()
+        self.assertIn('Other', [i.title for i in db.groups])
+
+    def test_stretched_once(self):
+        self.make_db(None)
+        with mock.patch.object(server, 'stretch_key',
+                               wraps=server.stretch_key) as stretch_key:
+            self.load(None)
+            self.load(None)
+        self.assertEqual(stretch_key.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()